@@ -0,0 +1,127 @@
+# Benchmarks for python-xkcd, run against the local stand-in server.
+#
+# Usage: python -m tests.benchmark [--latency 0.02] [--bandwidth 1000000]
+#        [--error-rate 0] [--output results.json] [--compare baseline.json]
+#
+# Each scenario is run a number of times; the throughput (operations per
+# second) and the median and 99th percentile latency of one operation are
+# reported. With --output the results are saved as JSON, and with --compare
+# they are printed next to those of an earlier run.
+
+import argparse
+import io
+import json
+import sys
+import time
+
+import xkcd
+
+from tests.server import StandInServer
+
+def percentile(samples, fraction):
+	"""	Returns the value below which "fraction" of the sorted "samples" fall."""
+	ordered = sorted(samples)
+	index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+	return ordered[index]
+
+def measure(operation, repeat, items=1):
+	"""	Calls "operation" "repeat" times and returns a dictionary of its
+		throughput, in items per second, and its latency percentiles."""
+	samples = []
+	started = time.time()
+	for i in range(repeat):
+		before = time.time()
+		operation(i)
+		samples.append(time.time() - before)
+	elapsed = time.time() - started
+	return {
+		"throughput": repeat * items / elapsed if elapsed > 0 else float("inf"),
+		"p50": percentile(samples, 0.5),
+		"p99": percentile(samples, 0.99),
+		"operations": repeat,
+	}
+
+def getComicScenario(server, repeat):
+	return measure(lambda i: xkcd.getComic(1 + i % server.latest), repeat)
+
+def getComicsScenario(server, repeat, batch=100):
+	def operation(i):
+		start = 1 + (i * batch) % (server.latest - batch)
+		xkcd.getComics(range(start, start + batch))
+	return measure(operation, max(1, repeat // 10), batch)
+
+def iterComicsScenario(server, repeat, batch=100):
+	def operation(i):
+		start = 1 + (i * batch) % (server.latest - batch)
+		for comic in xkcd.iterComics(start, start + batch):
+			pass
+	return measure(operation, max(1, repeat // 10), batch)
+
+def downloadScenario(server, repeat):
+	comics = xkcd.getComics(range(1, min(server.latest, repeat) + 1))
+	comics = [comic for comic in comics if isinstance(comic, xkcd.Comic) and comic.number > 0]
+	return measure(lambda i: comics[i % len(comics)].download(io.BytesIO()), repeat)
+
+def whatIfArchiveScenario(server, repeat):
+	def operation(i):
+		xkcd.whatIfArchive = xkcd.WhatIfArchive()
+		xkcd.getWhatIfArchive()
+	return measure(operation, max(1, repeat // 10))
+
+scenarios = [
+	("getComic", getComicScenario),
+	("getComics", getComicsScenario),
+	("iterComics", iterComicsScenario),
+	("download", downloadScenario),
+	("getWhatIfArchive", whatIfArchiveScenario),
+]
+
+def run(latency=0, bandwidth=None, errorRate=0, repeat=200, only=None):
+	"""	Runs every scenario (or those named in "only") against a fresh stand-in
+		server and returns a dictionary of their results, keyed by name."""
+	results = {}
+	for name, scenario in scenarios:
+		if only and name not in only:
+			continue
+		with StandInServer(latency=latency, bandwidth=bandwidth, errorRate=errorRate) as server:
+			result = scenario(server, repeat)
+			result["requests"] = server.totalRequests()
+			results[name] = result
+	return results
+
+def report(results, baseline=None):
+	"""	Prints a table of "results", with the change from "baseline" if given."""
+	header = "%-18s %12s %10s %10s" % ("scenario", "ops/s", "p50 ms", "p99 ms")
+	if baseline:
+		header += " %10s" % "vs base"
+	print(header)
+	for name, result in sorted(results.items()):
+		line = "%-18s %12.1f %10.2f %10.2f" % (name, result["throughput"],
+			result["p50"] * 1000, result["p99"] * 1000)
+		if baseline and name in baseline and baseline[name]["throughput"]:
+			line += " %9.2fx" % (result["throughput"] / baseline[name]["throughput"])
+		print(line)
+
+def main(arguments=None):
+	parser = argparse.ArgumentParser(description="Benchmark python-xkcd against a local stand-in server.")
+	parser.add_argument("--latency", type=float, default=0, help="seconds of delay added to every request")
+	parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per response")
+	parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail with 503")
+	parser.add_argument("--repeat", type=int, default=200, help="operations per scenario")
+	parser.add_argument("--scenario", action="append", help="only run this scenario (may be repeated)")
+	parser.add_argument("--output", help="save the results to this JSON file")
+	parser.add_argument("--compare", help="compare with results saved by an earlier run")
+	options = parser.parse_args(arguments)
+
+	results = run(options.latency, options.bandwidth, options.error_rate, options.repeat, options.scenario)
+	baseline = None
+	if options.compare:
+		with open(options.compare) as baselineFile:
+			baseline = json.load(baselineFile)
+	report(results, baseline)
+	if options.output:
+		with open(options.output, "w") as outputFile:
+			json.dump(results, outputFile, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,275 @@
+# A local stand-in for xkcd.com, imgs.xkcd.com and the What If archive.
+#
+# The server answers the same URLs the xkcd module uses, with made-up but
+# well-formed comics, images and archive entries, so the test suite and the
+# benchmarks can run offline. Latency, bandwidth and error rate can be set to
+# emulate a slow or unreliable origin.
+
+import gzip
+import hashlib
+import io
+import json
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import xkcd
+
+if sys.version_info[0] <= 2:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+else:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+def makePNG(width, height, size):
+	"""	Returns the bytes of a PNG image header for a "width" by "height" image,
+		padded with a dummy chunk to "size" bytes. It is not a decodable image,
+		but its header is valid, which is all the module looks at."""
+	def chunk(kind, data):
+		crc = zlib.crc32(kind + data) & 0xffffffff
+		return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+	header = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+	padding = max(0, size - len(header) - 12 - 12)
+	return header + chunk(b"tEXt", b"x" * padding) + chunk(b"IEND", b"")
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		# The headers and body are written separately; don't let Nagle's
+		# algorithm hold the body back waiting for an ACK.
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def log_message(self, *args):
+		pass
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		server = self.server
+		path = self.path
+		match = re.match(r"^https?://[^/]+(/.*)$", path)
+		if match:
+			# A request sent to a proxy names the whole URL; act as the proxy too.
+			server.proxied.append((path, self.headers.get("Proxy-Authorization")))
+			path = match.group(1)
+		category, status, body, contentType, headers = server.route(path, self.headers)
+		if status < 400 and server.errorRate and server.random.random() < server.errorRate:
+			category, status, body, contentType, headers = "error", 503, b"Unavailable", "text/plain", {"Retry-After": "0"}
+		server.count(category)
+		if server.latency:
+			time.sleep(server.latency)
+
+		acceptsGzip = "gzip" in (self.headers.get("Accept-Encoding") or "")
+		if acceptsGzip and body and not contentType.startswith("image/") and status == 200:
+			compressed = io.BytesIO()
+			with gzip.GzipFile(fileobj=compressed, mode="wb") as gzipFile:
+				gzipFile.write(body)
+			body = compressed.getvalue()
+			headers["Content-Encoding"] = "gzip"
+
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		if not server.keepAlive:
+			self.send_header("Connection", "close")
+			self.close_connection = True
+		self.end_headers()
+		if self.command == "HEAD":
+			return
+		server.countBytes(len(body))
+		if server.bandwidth:
+			# Trickle the body out to emulate a slow link.
+			chunkSize = max(1, int(server.bandwidth / 20))
+			for start in range(0, len(body), chunkSize):
+				self.wfile.write(body[start:start + chunkSize])
+				time.sleep(float(len(body[start:start + chunkSize])) / server.bandwidth)
+		else:
+			self.wfile.write(body)
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+	"""
+		A threaded HTTP server on localhost that emulates the parts of xkcd.com,
+		imgs.xkcd.com and what-if.xkcd.com that the xkcd module uses:
+
+			/info.0.json and /(number)/info.0.json: comic metadata, with ETags
+			/comics/(name).png: images, with Range and If-Range support; 2x versions exist
+			only for even-numbered comics
+			/archive/: the What If archive page
+			/redirect/(path): a 302 redirect to /(path)
+
+		Comic 404 does not exist, as on the real site. JSON and HTML are gzipped
+		for clients that ask. "latency" adds a delay in seconds to every request,
+		"bandwidth" limits response bodies to that many bytes per second, and
+		"errorRate" is the fraction of requests answered with 503. Setting
+		"keepAlive" to False closes the connection after every response.
+		Requests for whole URLs, as sent to a proxy, are answered as if the
+		server were the proxy, and recorded with their Proxy-Authorization
+		header in "proxied".
+
+		Use it as a context manager to point the xkcd module at it:
+
+			with StandInServer() as server:
+				xkcd.getComic(1)
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def __init__(self, latest=1100, whatIfs=150, imageSize=20000, latency=0,
+			bandwidth=None, errorRate=0, seed=0):
+		HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+		self.latest = latest
+		self.whatIfs = whatIfs
+		self.imageSize = imageSize
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.errorRate = errorRate
+		self.keepAlive = True
+		self.random = random.Random(seed)
+		self.requests = {}
+		self.proxied = []
+		self.bytesSent = 0
+		self._lock = threading.Lock()
+		self._thread = None
+		self._saved = None
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:" + str(self.server_address[1]) + "/"
+
+	def count(self, category):
+		with self._lock:
+			self.requests[category] = self.requests.get(category, 0) + 1
+
+	def countBytes(self, size):
+		with self._lock:
+			self.bytesSent += size
+
+	def totalRequests(self):
+		return sum(self.requests.values())
+
+	def comicData(self, number):
+		return {
+			"num": number, "safe_title": u"Comic " + str(number), "title": u"Comic " + str(number),
+			"alt": u"Alt text for comic " + str(number) + u" \u2013 caf\u00e9",
+			"img": self.url + "comics/comic_" + str(number) + ".png",
+			"year": str(2006 + number // 156), "month": str(1 + number // 13 % 12),
+			"day": str(1 + number % 28), "transcript": "", "news": "", "link": "",
+		}
+
+	def image(self, number, x2):
+		scale = 2 if x2 else 1
+		return makePNG(scale * (100 + number), scale * (50 + number % 100), scale * self.imageSize)
+
+	def archive(self):
+		entries = []
+		for number in range(1, self.whatIfs + 1):
+			link = "//what-if.xkcd.com/" + str(number) + "/"
+			entries.append('<div class="archive-entry"><a href="' + link + '"><img src="/imgs/a/' +
+				str(number) + '/archive_crop.png"></a><h1 class="archive-title"><a href="' + link +
+				'">What If ' + str(number) + '</a></h1><h2 class="archive-date">2012</h2></div>')
+		return ('<html><body><div id="archive-wrapper">' + "".join(entries) + '</div></body></html>').encode("utf-8")
+
+	def route(self, path, requestHeaders):
+		"""	Returns (category, status, body, content type, headers) for "path"."""
+		match = re.match(r"^/(?:(\d+)/)?info\.0\.json$", path)
+		if match:
+			number = int(match.group(1) or self.latest)
+			category = "metadata" if match.group(1) else "latest"
+			if number > self.latest or number == 404 or number <= 0:
+				return category, 404, b"Not Found", "text/plain", {}
+			return self.conditional(category, json.dumps(self.comicData(number)).encode("utf-8"),
+				"application/json", requestHeaders)
+
+		match = re.match(r"^/comics/comic_(\d+)(_2x)?\.png$", path)
+		if match:
+			number, x2 = int(match.group(1)), match.group(2) is not None
+			if number > self.latest or (x2 and number % 2):
+				return "image", 404, b"Not Found", "text/plain", {}
+			return self.ranged(self.image(number, x2), requestHeaders)
+
+		if path.startswith("/redirect/"):
+			return "other", 302, b"", "text/plain", {"Location": "/" + path[len("/redirect/"):]}
+		if path == "/archive/":
+			return self.conditional("archive", self.archive(), "text/html; charset=utf-8", requestHeaders)
+		return "other", 404, b"Not Found", "text/plain", {}
+
+	def conditional(self, category, body, contentType, requestHeaders):
+		etag = '"' + hashlib.md5(body).hexdigest() + '"'
+		if requestHeaders.get("If-None-Match") == etag:
+			return category, 304, b"", contentType, {"ETag": etag}
+		return category, 200, body, contentType, {"ETag": etag}
+
+	def ranged(self, body, requestHeaders):
+		etag = '"' + hashlib.md5(body).hexdigest() + '"'
+		headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+		match = re.match(r"^bytes=(\d+)-(\d*)$", requestHeaders.get("Range") or "")
+		ifRange = requestHeaders.get("If-Range")
+		if not match or (ifRange is not None and ifRange != etag):
+			return "image", 200, body, "image/png", headers
+		start = int(match.group(1))
+		end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+		if start >= len(body):
+			headers["Content-Range"] = "bytes */" + str(len(body))
+			return "image", 416, b"", "image/png", headers
+		headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(len(body))
+		return "image", 206, body[start:end + 1], "image/png", headers
+
+	def handle_error(self, request, clientAddress):
+		# Clients that give up on a slow response hang up on it; that is expected.
+		if not isinstance(sys.exc_info()[1], socket.error):
+			HTTPServer.handle_error(self, request, clientAddress)
+
+	def start(self):
+		"""	Starts serving on a background thread."""
+		self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""	Stops serving and closes the socket."""
+		self.shutdown()
+		self.server_close()
+
+	def install(self):
+		"""	Points the xkcd module at this server, forgetting anything it has
+			remembered from wherever it pointed before."""
+		self._saved = (xkcd.xkcdUrl, xkcd.imageUrl, xkcd.archiveUrl)
+		xkcd.xkcdUrl = self.url
+		xkcd.imageUrl = self.url + "comics/"
+		xkcd.archiveUrl = self.url + "archive/"
+		xkcd.latestComicNum = xkcd.LatestComicNum()
+		xkcd.whatIfArchive = xkcd.WhatIfArchive()
+		xkcd.x2Resolver = xkcd.X2Resolver()
+
+	def uninstall(self):
+		"""	Points the xkcd module back at wherever it pointed before install()."""
+		xkcd.xkcdUrl, xkcd.imageUrl, xkcd.archiveUrl = self._saved
+		xkcd.latestComicNum = xkcd.LatestComicNum()
+		xkcd.whatIfArchive = xkcd.WhatIfArchive()
+		xkcd.x2Resolver = xkcd.X2Resolver()
+		xkcd._pool.close()
+
+	def __enter__(self):
+		self.start()
+		self.install()
+		return self
+
+	def __exit__(self, *exception):
+		self.uninstall()
+		self.stop()
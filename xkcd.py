@@ -18,31 +18,1804 @@ The xkcd module, as of version 2.4.0, also supports getting information on
 What If articles from whatif.xkcd.com. This information is generated by
 scraping the What If archive page with a HTML parser."""
 
-import copy
+import array
+import base64
+import bisect
+import codecs
+import collections
+import datetime
+import email.utils
+import gzip
+import hashlib
+import io
+import heapq
 import json
+import math
+import mmap
 import os
 import random
+import re
+import shutil
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
+import unicodedata
 import webbrowser
+import zlib
 
 # Python 3 support!
 if sys.version_info[0] <= 2:
 	import urllib2 as urllib
-	from urlparse import urlparse
+	from urllib import getproxies, proxy_bypass, unquote
+	from urlparse import urlparse, urljoin
 	import HTMLParser
+	import httplib
+	_unichr = unichr
+	_unescapeHTML = HTMLParser.HTMLParser().unescape
 else:
 	# This is kind of broken but I'm not sure of a better way.
 	import urllib.request as urllib
-	from urllib.parse import urlparse
+	from urllib.request import getproxies, proxy_bypass
+	from urllib.parse import urlparse, urljoin, unquote
 	import html.parser as HTMLParser
+	import http.client as httplib
+	_unichr = chr
+	from html import unescape as _unescapeHTML
+
+# asyncio only exists on Python 3; xkcd.aio is None without it.
+try:
+	import asyncio
+	import collections.abc
+	import concurrent.futures
+	import functools
+except ImportError:
+	asyncio = None
 
 # Define the URLs as globals.
 xkcdUrl = "https://www.xkcd.com/"			# The URL for xkcd.
 imageUrl = "https://imgs.xkcd.com/comics/"	# The root URL for image retrieval.
 explanationUrl = "https://explainxkcd.com/"	# The URL of the explanation.
 archiveUrl = "https://what-if.xkcd.com/archive/"	# The What If Archive URL.
+whatIfUrl = "https://what-if.xkcd.com/"		# The root URL of What If articles.
 
-class WhatIf:
+# The words that SearchIndex indexes.
+_wordPattern = re.compile(r"\w+", re.UNICODE)
+
+# The cache consulted by Comic objects before they hit the network; see setMetadataCache().
+metadataCache = None
+
+# The offline snapshot that comics and What Ifs are served from; see setSnapshot().
+snapshot = None
+
+# The cache that comic images are served from before they hit the network; see setImageCache().
+imageCache = None
+
+# The prefetcher that warms the caches for comics likely to be asked for next; see enablePrefetch().
+prefetcher = None
+
+# The metadata cache enablePrefetch() installed for want of one, removed again by disablePrefetch().
+_prefetchCache = None
+
+# How long, in seconds, the latest comic number is trusted before it is checked again.
+latestComicTTL = 300
+
+# How long, in seconds, the parsed What If archive is trusted before it is checked again.
+whatIfArchiveTTL = 3600
+
+# How failed requests are retried, with jittered exponential backoff; see _request().
+maxRetries = 3			# The number of retries after the first attempt.
+retryBackoff = 0.5		# The base delay in seconds, doubled after every attempt.
+retryMaxDelay = 30		# The longest delay in seconds, even if Retry-After asks for more.
+retryStatuses = (429, 500, 502, 503, 504)	# The HTTP statuses worth retrying.
+
+# The per-host rate limiter that every request waits on; see setRateLimit().
+rateLimiter = None
+
+# How long, in seconds, to wait for a connection to be made and for each read
+# from it; None waits forever. See timeouts() to change them for some calls.
+connectTimeout = 10
+readTimeout = 30
+
+# Timeouts and deadlines.
+
+class DeadlineExceeded(socket.timeout):
+
+	"""	Raised when an operation given a deadline (see :func:`timeouts`) has not
+		finished by then. It is a subclass of socket.timeout, so code that
+		already handles timeouts handles it too."""
+
+# The timeouts and deadline set for the current thread by timeouts(). Only
+# the overrides are kept, with None for the module-level defaults, so that
+# later changes to connectTimeout and readTimeout still apply.
+_local = threading.local()
+
+class _TimeoutScope(object):
+
+	"""	The context manager returned by :func:`timeouts`. This class is designed
+		for internal usage only."""
+
+	def __init__(self, connect, read, deadline):
+		self.connect = connect
+		self.read = read
+		self.deadline = deadline
+		self._saved = None
+
+	def __enter__(self):
+		self._saved = _timeoutOverrides()
+		connect, read, deadline = self._saved
+		if self.connect is not None:
+			connect = self.connect
+		if self.read is not None:
+			read = self.read
+		if self.deadline is not None:
+			# A nested deadline can only shorten the one already running.
+			expires = time.time() + self.deadline
+			deadline = expires if deadline is None else min(deadline, expires)
+		_local.timeouts = (connect, read, deadline)
+		return self
+
+	def __exit__(self, *exception):
+		_local.timeouts = self._saved
+
+def timeouts(connect=None, read=None, deadline=None):
+	"""	Returns a context manager that changes the timeouts of every request made
+		by the current thread within it. This includes requests made on its
+		behalf by worker threads, e.g. by :func:`getComics`:
+
+			with xkcd.timeouts(read=5, deadline=20):
+				comics = xkcd.getComics(range(1, 101))
+
+		Arguments:
+			connect: how long, in seconds, to wait for a connection to be made.
+			Defaults to the module-level connectTimeout.
+
+			read: how long, in seconds, to wait for each read from a connection.
+			Defaults to the module-level readTimeout.
+
+			deadline: how long, in seconds, everything in the block may take,
+			including retries and waits for the rate limiter. Once it has passed,
+			the request under way raises :class:`DeadlineExceeded`.
+
+		Most functions that make requests also take a "deadline" argument, which
+		is a shortcut for this."""
+	return _TimeoutScope(connect, read, deadline)
+
+def _timeoutOverrides():
+	# Returns the (connect timeout, read timeout, deadline) set by timeouts() on
+	# the current thread, each None if it was not set.
+	return getattr(_local, "timeouts", None) or (None, None, None)
+
+def _currentTimeouts():
+	# Returns (connect timeout, read timeout, deadline) for the current thread;
+	# the deadline is an absolute time, or None.
+	connect, read, deadline = _timeoutOverrides()
+	return (connectTimeout if connect is None else connect,
+		readTimeout if read is None else read, deadline)
+
+def _socketTimeout(timeout, deadline, url):
+	"""	Returns the timeout for one socket operation, shortened so that it does
+		not run past "deadline", or raises DeadlineExceeded if that has passed."""
+	if deadline is None:
+		return timeout
+	remaining = deadline - time.time()
+	if remaining <= 0:
+		raise DeadlineExceeded("Deadline exceeded while requesting " + url)
+	return remaining if timeout is None else min(timeout, remaining)
+
+def _checkDeadline(delay, url):
+	# Raises DeadlineExceeded if waiting "delay" seconds would pass the deadline.
+	deadline = _currentTimeouts()[2]
+	if deadline is not None and time.time() + delay >= deadline:
+		raise DeadlineExceeded("Deadline exceeded while requesting " + url)
+
+# Network and caching helpers.
+
+class _Response:
+
+	"""	A response from the :class:`_ConnectionPool`. It reads like a file,
+		transparently decompresses gzip-encoded bodies, and hands its connection
+		back to the pool once the body has been read to the end and closed."""
+
+	def __init__(self, pool, key, connection, response, url, sock):
+		self.url = url
+		self.status = response.status
+		self.reason = response.reason
+		self.headers = response.msg
+		self._pool = pool
+		self._key = key
+		self._connection = connection
+		self._response = response
+		# The connection forgets its socket once the server says it will close
+		# it, but the body is still read from that socket.
+		self._socket = sock
+		self._finished = False
+		self._decompressor = None
+		# Set by _request, so that the request is reported once this is closed.
+		self._event = None
+		self.bytesRead = 0
+		self._readTimeout, self._deadline = _currentTimeouts()[1:]
+		if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+			self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+	def getheader(self, name, default=None):
+		return self._response.getheader(name, default)
+
+	def read(self, amount=None):
+		"""	Reads and returns up to "amount" bytes of the body, or all of it if
+			"amount" is None. An empty result means the body is exhausted."""
+		if self._finished:
+			return b""
+		if self._deadline is not None and self._connection is not None:
+			# Every read must finish before the deadline, not just each recv.
+			timeout = _socketTimeout(self._readTimeout, self._deadline, self.url)
+			try:
+				self._socket.settimeout(timeout)
+			except socket.error:
+				# A connection that is not kept alive is closed once the body
+				# has been read; the next read just reports the end of it.
+				pass
+		try:
+			return self._read(amount)
+		except socket.timeout:
+			if self._deadline is not None and time.time() >= self._deadline:
+				raise DeadlineExceeded("Deadline exceeded while reading " + self.url)
+			raise
+
+	def _read(self, amount):
+		if amount is None:
+			data = self._response.read()
+			self.bytesRead += len(data)
+			self._finished = True
+			if self._decompressor is not None:
+				data = self._decompressor.decompress(data) + self._decompressor.flush()
+			return data
+		while True:
+			data = self._response.read(amount)
+			self.bytesRead += len(data)
+			if not data:
+				self._finished = True
+				if self._decompressor is not None:
+					return self._decompressor.flush()
+				return b""
+			if self._decompressor is None:
+				return data
+			data = self._decompressor.decompress(data)
+			if data:
+				return data
+
+	def close(self):
+		"""	Releases the connection. It is reused if the body was read in full,
+			and closed otherwise."""
+		if self._connection is None:
+			return
+		connection, self._connection = self._connection, None
+		reusable = self._finished and not self._response.will_close
+		self._response.close()
+		if reusable:
+			self._pool.checkin(self._key, connection)
+		else:
+			connection.close()
+		if self._event is not None:
+			category, method, started = self._event
+			cache = "revalidated" if self.status == 304 else "miss"
+			_emit(RequestEvent(category, self.url, method, self.status, time.time() - started,
+				self.bytesRead, cache))
+
+class _ConnectionPool:
+
+	"""	Keeps persistent HTTP(S) connections to each host the module talks to,
+		so that consecutive requests to xkcd.com or imgs.xkcd.com do not each
+		pay for a new TCP and TLS handshake.
+
+		Connections are checked out for the duration of one request and returned
+		once its response has been read. At most "maxIdle" idle connections are
+		kept per host, and those unused for more than "idleTimeout" seconds are
+		closed rather than reused. This class is designed for internal usage only."""
+
+	def __init__(self, maxIdle=4, idleTimeout=60):
+		self.maxIdle = maxIdle
+		self.idleTimeout = idleTimeout
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	def _connect(self, key):
+		scheme, host, port = key
+		connectionClass = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+		proxy = None
+		if not proxy_bypass(host):
+			proxy = getproxies().get(scheme)
+		if proxy is None:
+			return connectionClass(host, port)
+		# Tunnel through the proxy configured in the environment, as urllib would,
+		# sending the credentials in its URL (if any) with Basic authentication.
+		proxy = urlparse(proxy if "://" in proxy else "http://" + proxy)
+		proxyHeaders = {}
+		if proxy.username is not None:
+			credentials = unquote(proxy.username) + ":" + unquote(proxy.password or "")
+			proxyHeaders["Proxy-Authorization"] = "Basic " + \
+				base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+		connection = connectionClass(proxy.hostname, proxy.port or 80)
+		if scheme == "https":
+			connection.set_tunnel(host, port, proxyHeaders)
+		else:
+			# Plain requests go to the proxy with the whole URL and the proxy headers.
+			connection._xkcdProxyHeaders = proxyHeaders
+		return connection
+
+	def checkout(self, key):
+		"""	Returns an idle connection for "key", a (scheme, host, port) tuple,
+			and whether it was reused; a new connection is made if none is idle."""
+		with self._lock:
+			self._evictIdle(time.time())
+			idle = self._idle.get(key, [])
+			if len(idle) > 0:
+				return idle.pop()[0], True
+		return self._connect(key), False
+
+	def checkin(self, key, connection):
+		"""	Returns "connection" to the pool once a response has been read."""
+		now = time.time()
+		with self._lock:
+			self._evictIdle(now)
+			idle = self._idle.setdefault(key, [])
+			if len(idle) < self.maxIdle:
+				idle.append((connection, now))
+				return
+		connection.close()
+
+	def evictIdle(self):
+		"""	Closes every connection that has been idle for too long. This also
+			happens whenever a connection is checked out or in."""
+		with self._lock:
+			self._evictIdle(time.time())
+
+	def _evictIdle(self, now):
+		# Connections are appended as they are checked in, so the ones idle for
+		# too long are at the front of each list. Must be called with the lock held.
+		for idle in self._idle.values():
+			while len(idle) > 0 and now - idle[0][1] > self.idleTimeout:
+				idle.pop(0)[0].close()
+
+	def close(self):
+		"""	Closes every idle connection."""
+		with self._lock:
+			for idle in self._idle.values():
+				for connection, lastUsed in idle:
+					connection.close()
+			self._idle = {}
+
+	def request(self, method, url, headers):
+		"""	Sends one request and returns a :class:`_Response`, without
+			following redirects or raising for error statuses."""
+		parsed = urlparse(url)
+		scheme = parsed.scheme.lower()
+		port = parsed.port or (443 if scheme == "https" else 80)
+		key = (scheme, parsed.hostname, port)
+		path = parsed.path or "/"
+		if parsed.query:
+			path += "?" + parsed.query
+
+		connect, read, deadline = _currentTimeouts()
+		while True:
+			connection, reused = self.checkout(key)
+			target, requestHeaders = path, headers
+			proxyHeaders = getattr(connection, "_xkcdProxyHeaders", None)
+			if proxyHeaders is not None:
+				target = url
+				requestHeaders = dict(headers)
+				requestHeaders.update(proxyHeaders)
+			try:
+				connection.timeout = _socketTimeout(connect, deadline, url)
+				if connection.sock is not None:
+					connection.sock.settimeout(_socketTimeout(read, deadline, url))
+				connection.request(method, target, headers=requestHeaders)
+				# A new connection was made with the connect timeout.
+				sock = connection.sock
+				sock.settimeout(_socketTimeout(read, deadline, url))
+				response = connection.getresponse()
+			except (httplib.HTTPException, socket.error) as error:
+				connection.close()
+				if isinstance(error, socket.timeout) and deadline is not None and time.time() >= deadline:
+					raise DeadlineExceeded("Deadline exceeded while requesting " + url)
+				# The server may have dropped an idle connection; retry once on a new one.
+				if reused and not isinstance(error, socket.timeout):
+					continue
+				raise
+			if method == "HEAD":
+				response.read()
+			result = _Response(self, key, connection, response, url, sock)
+			if method == "HEAD":
+				result._finished = True
+			return result
+
+# The connection pool used for every request the module makes.
+_pool = _ConnectionPool()
+
+# The User-Agent sent with every request.
+userAgent = "python-xkcd"
+
+# Instrumentation.
+
+class RequestEvent(object):
+
+	"""
+		Describes one request the module made, or one lookup it answered from a
+		cache instead. Every function registered with :func:`addRequestHook` is
+		called with one of these.
+
+		Attributes:
+			category: what was requested: "metadata" (a comic's info.0.json),
+			"latest" (the latest comic's info.0.json), "image", "archive" (the
+			What If archive), or "other".
+
+			url, method: the URL and HTTP method of the request.
+
+			status: the HTTP status code, or None if no response was received or
+			the lookup was answered from a cache.
+
+			elapsed: the time taken in seconds, including reading the body.
+
+			bytes: the number of body bytes received, before decompression.
+
+			cache: "hit" if the lookup was answered from a cache without a request,
+			"revalidated" if a conditional request was answered with 304 Not
+			Modified, and "miss" if the body was fetched.
+
+			error: the exception raised by the request, or None.
+	"""
+
+	__slots__ = ("category", "url", "method", "status", "elapsed", "bytes", "cache", "error")
+
+	def __init__(self, category, url, method, status, elapsed, bytes, cache, error=None):
+		self.category = category
+		self.url = url
+		self.method = method
+		self.status = status
+		self.elapsed = elapsed
+		self.bytes = bytes
+		self.cache = cache
+		self.error = error
+
+	def __repr__(self):
+		return "RequestEvent(%s %s %s %s %s, %.1f ms, %d bytes)" % (self.category, self.method,
+			self.url, self.status, self.cache, self.elapsed * 1000, self.bytes)
+
+class RequestStats(object):
+
+	"""
+		Aggregates :class:`RequestEvent` objects. For every category it counts
+		requests, errors, cache hits, misses and revalidations, bytes received,
+		time spent and responses by status code, and keeps a histogram of
+		request latencies.
+
+		The module reports to one of these, xkcd.requestStats, by default;
+		:func:`snapshot` returns its numbers as plain dictionaries, ready to hand
+		to another metrics system. Register another with :func:`addRequestHook`
+		to aggregate a different set of requests.
+	"""
+
+	# The upper bounds, in seconds, of the latency histogram buckets. One more
+	# bucket counts everything slower.
+	buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.categories = {}
+
+	def __call__(self, event):
+		with self._lock:
+			stats = self.categories.get(event.category)
+			if stats is None:
+				stats = {"requests": 0, "errors": 0, "hits": 0, "misses": 0, "revalidated": 0,
+					"bytes": 0, "elapsed": 0.0, "statuses": {},
+					"histogram": [0] * (len(self.buckets) + 1)}
+				self.categories[event.category] = stats
+			if event.cache == "hit":
+				stats["hits"] += 1
+				return
+			stats["requests"] += 1
+			if event.error is not None:
+				stats["errors"] += 1
+			elif event.cache == "revalidated":
+				stats["revalidated"] += 1
+			else:
+				stats["misses"] += 1
+			stats["bytes"] += event.bytes
+			stats["elapsed"] += event.elapsed
+			if event.status is not None:
+				stats["statuses"][event.status] = stats["statuses"].get(event.status, 0) + 1
+			stats["histogram"][bisect.bisect_left(self.buckets, event.elapsed)] += 1
+
+	def snapshot(self):
+		"""	Returns a copy of the statistics: a dictionary mapping each category
+			to a dictionary of its counters. "histogram" is a list with the number
+			of requests that fell in each of the buckets, then the number slower
+			than the last."""
+		with self._lock:
+			return dict((category, dict(stats, statuses=dict(stats["statuses"]),
+				histogram=list(stats["histogram"]))) for category, stats in self.categories.items())
+
+	def reset(self):
+		"""	Sets every counter back to zero."""
+		with self._lock:
+			self.categories = {}
+
+# The default aggregator of request events.
+requestStats = RequestStats()
+
+# The functions called with a RequestEvent for every request.
+_requestHooks = [requestStats]
+
+def addRequestHook(hook):
+	"""	Registers "hook", a function taking a :class:`RequestEvent`, to be called
+		after every request the module makes and every lookup it answers from a
+		cache. Hooks are called on whichever thread made the request, so they
+		should be quick and thread-safe; exceptions they raise are ignored."""
+	_requestHooks.append(hook)
+
+def removeRequestHook(hook):
+	"""	Unregisters a hook added with :func:`addRequestHook`. The default
+		aggregator, xkcd.requestStats, can be removed this way too."""
+	if hook in _requestHooks:
+		_requestHooks.remove(hook)
+
+def _emit(event):
+	for hook in list(_requestHooks):
+		try:
+			hook(event)
+		except Exception:
+			pass
+
+def _emitHit(category, url):
+	# Reports a lookup answered without making a request.
+	if _requestHooks:
+		_emit(RequestEvent(category, url, "GET", None, 0.0, 0, "hit"))
+
+# Rate limiting and retries.
+
+class RateLimiter(object):
+
+	"""
+		A token-bucket rate limiter, keeping a separate bucket for each host.
+		Every host can be sent "rate" requests per second on average, in bursts
+		of up to "burst" requests. It is thread-safe, so one limiter can pace
+		every thread (and every xkcd.aio call, which run on threads) at once.
+	"""
+
+	def __init__(self, rate, burst=None):
+		if rate <= 0:
+			raise ValueError("The rate must be greater than 0, not " + str(rate))
+		self.rate = float(rate)
+		self.burst = float(burst if burst is not None else max(1, rate))
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def reserve(self, host):
+		"""	Takes a token from the bucket of "host" and returns how long, in
+			seconds, the caller must wait before using it. The token is taken
+			even if it is not there yet, so waiting callers are served in order."""
+		with self._lock:
+			now = time.time()
+			tokens, updated = self._buckets.get(host, (self.burst, now))
+			tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+			self._buckets[host] = (tokens, now)
+		return max(0.0, -tokens / self.rate)
+
+	def acquire(self, host):
+		"""	Blocks until a request may be sent to "host"."""
+		delay = self.reserve(host)
+		if delay > 0:
+			time.sleep(delay)
+
+def setRateLimit(rate, burst=None):
+	"""	Limits the module to "rate" requests per second to each host, on
+		average, with bursts of up to "burst" requests (by default, "rate"
+		rounded up to at least 1). The limit is shared by every thread.
+		Passing None as the rate removes the limit; a rate of 0 or less
+		raises ValueError."""
+	global rateLimiter
+	rateLimiter = RateLimiter(rate, burst) if rate is not None else None
+
+def _parseRetryAfter(value):
+	# A Retry-After header is either a number of seconds or an HTTP date.
+	if not value:
+		return None
+	value = value.strip()
+	if value.isdigit():
+		return float(value)
+	parsed = email.utils.parsedate_tz(value)
+	if parsed is None:
+		return None
+	return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+def _retryDelay(error, method, attempt):
+	"""	Returns how long to wait, in seconds, before retrying a request that
+		failed with "error" on its "attempt"th retry, or None if it should not be
+		retried. A Retry-After header is obeyed; otherwise the delay is drawn at
+		random from an exponentially growing range ("full jitter"), so that
+		threads which failed together do not retry together."""
+	if attempt >= maxRetries or method not in ("GET", "HEAD") or isinstance(error, DeadlineExceeded):
+		return None
+	if isinstance(error, urllib.HTTPError):
+		if error.code not in retryStatuses:
+			return None
+		retryAfter = _parseRetryAfter(error.headers.get("Retry-After") if error.headers else None)
+		if retryAfter is not None:
+			return min(retryAfter, retryMaxDelay)
+	elif not isinstance(error, (httplib.HTTPException, socket.error)):
+		return None
+	return random.uniform(0, min(retryMaxDelay, retryBackoff * 2 ** attempt))
+
+def _request(url, headers=None, method="GET", compressed=True, category="other"):
+	"""	Makes an HTTP request through the shared connection pool, following
+		redirects. This is the single path through which the module talks to
+		the network, and it reports every request to the hooks registered with
+		:func:`addRequestHook` once its response is closed.
+
+		Every request waits for the rate limiter, if one is set (see
+		:func:`setRateLimit`). Requests that fail with a connection error or a
+		status in retryStatuses are retried up to maxRetries times, with
+		jittered exponential backoff.
+
+		Arguments:
+			url: the URL to request.
+
+			headers: a dictionary of extra request headers.
+
+			method: the HTTP method, defaults to GET.
+
+			compressed: boolean, defaults to True. If set, the response may be
+			gzip-encoded (it is decompressed transparently); images should set
+			this to False since they are already compressed.
+
+			category: the kind of request, as reported in :class:`RequestEvent`.
+
+		Returns a :class:`_Response`, which must be closed. A 304 Not Modified reply
+		to a conditional request is returned like any other response; any other
+		status of 400 or above raises an HTTPError, as urlopen would."""
+	attempt = 0
+	while True:
+		started = time.time()
+		try:
+			response = _send(url, headers, method, compressed)
+		except Exception as error:
+			_emit(RequestEvent(category, url, method, getattr(error, "code", None),
+				time.time() - started, 0, "miss", error))
+			delay = _retryDelay(error, method, attempt)
+			if delay is None:
+				raise
+			_checkDeadline(delay, url)
+			attempt += 1
+			time.sleep(delay)
+			continue
+		response._event = (category, method, started)
+		return response
+
+def _send(url, headers, method, compressed):
+	requestHeaders = {"User-Agent": userAgent}
+	if compressed:
+		requestHeaders["Accept-Encoding"] = "gzip"
+	requestHeaders.update(headers or {})
+
+	for redirect in range(10):
+		limiter = rateLimiter
+		if limiter is not None:
+			delay = limiter.reserve(urlparse(url).hostname)
+			if delay > 0:
+				_checkDeadline(delay, url)
+				time.sleep(delay)
+		response = _pool.request(method, url, requestHeaders)
+		location = response.getheader("Location")
+		if response.status in (301, 302, 303, 307, 308) and location:
+			response.read()
+			response.close()
+			url = urljoin(url, location)
+			continue
+		if response.status >= 400:
+			body = response.read()
+			response.close()
+			raise urllib.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+		return response
+	raise urllib.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+def _fetch(url, headers=None, compressed=True, category="other"):
+	"""	Performs a GET request for the provided URL, sending any extra headers
+		given in the "headers" dictionary. See :func:`_request` for "compressed"
+		and "category".
+
+		Returns a tuple of (status, response headers, body). A 304 Not Modified
+		reply to a conditional request is returned with an empty body rather
+		than raised as an error; any other HTTP error is raised as usual."""
+	response = _request(url, headers, compressed=compressed, category=category)
+	try:
+		body = response.read()
+	finally:
+		response.close()
+	return response.status, response.headers, body
+
+class _SingleFlight(object):
+
+	"""	Coalesces concurrent identical work: while a call for some key is in
+		flight, other callers asking for the same key wait for it and share its
+		result or exception instead of repeating it. Once the call finishes the
+		key is forgotten, so later callers start afresh; caching results is left
+		to the caches. This class is designed for internal usage only."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# Key -> [finished event, result, exception] of the call in flight.
+		self._calls = {}
+
+	def do(self, key, function, *args):
+		"""	Returns function(*args), or the result of the call already in flight
+			for "key" if there is one. A call that ran out of its caller's
+			deadline is not shared: the callers waiting for it start again under
+			their own timeouts."""
+		while True:
+			with self._lock:
+				call = self._calls.get(key)
+				leader = call is None
+				if leader:
+					call = [threading.Event(), None, None]
+					self._calls[key] = call
+			if leader:
+				break
+			deadline = _currentTimeouts()[2]
+			if deadline is None:
+				call[0].wait()
+			elif not call[0].wait(max(0, deadline - time.time())):
+				raise DeadlineExceeded("Deadline exceeded while waiting for " + str(key))
+			if isinstance(call[2], DeadlineExceeded):
+				continue
+			if call[2] is not None:
+				raise call[2]
+			return call[1]
+		try:
+			call[1] = function(*args)
+		except Exception as error:
+			call[2] = error
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call[0].set()
+		return call[1]
+
+# The coalescer shared by every fetch of comic metadata, the latest comic
+# number, the What If archive and images.
+_inFlight = _SingleFlight()
+
+def _copyResponse(response, destination, chunkSize=65536):
+	"""	Copies the body of "response" to the writable file object "destination"
+		in chunks, and returns the number of bytes copied."""
+	copied = 0
+	while True:
+		chunk = response.read(chunkSize)
+		if not chunk:
+			return copied
+		destination.write(chunk)
+		copied += len(chunk)
+
+def _responseValidator(response):
+	"""	Returns the strong ETag of "response", or failing that its Last-Modified
+		date, for use in an If-Range header; None if it has neither."""
+	etag = response.getheader("ETag")
+	if etag and not etag.startswith("W/"):
+		return etag
+	return response.getheader("Last-Modified")
+
+def _readValidator(url, partial):
+	"""	Returns the validator recorded next to the file "partial" when it was
+		started, or None if there is none or it was downloaded from another URL."""
+	try:
+		with open(partial + ".validator", "rb") as record:
+			data = json.loads(record.read().decode("utf-8"))
+	except (IOError, OSError, ValueError):
+		return None
+	if not isinstance(data, dict) or data.get("url") != url:
+		return None
+	return data.get("validator")
+
+def _writeValidator(url, partial, response):
+	"""	Records the URL and validator of "response" next to the file "partial",
+		so an interrupted download is only resumed from the same resource."""
+	validator = _responseValidator(response)
+	try:
+		if validator is None:
+			if os.path.exists(partial + ".validator"):
+				os.remove(partial + ".validator")
+			return
+		with open(partial + ".validator", "wb") as record:
+			record.write(json.dumps({"url": url, "validator": validator}).encode("utf-8"))
+	except (IOError, OSError):
+		pass
+
+def _requestRemainder(url, partial):
+	"""	Requests "url" for downloading into the file "partial". If that file
+		already holds the start of the body, only the rest is asked for with a
+		Range request, made conditional with If-Range on the validator recorded
+		when the file was started. The response's status is 206 if it continues
+		the partial file, and 200 if the whole body is being sent and the file
+		should be overwritten: the resource changed, or the partial file came
+		from another URL or has no validator to check it against."""
+	offset = 0
+	if os.path.exists(partial):
+		offset = os.path.getsize(partial)
+	validator = _readValidator(url, partial) if offset else None
+	if validator is None:
+		return _request(url, compressed=False, category="image")
+
+	headers = {"Range": "bytes=" + str(offset) + "-", "If-Range": validator}
+	try:
+		response = _request(url, headers, compressed=False, category="image")
+	except urllib.HTTPError as error:
+		# 416 means the partial file cannot be continued; start over.
+		if error.code != 416:
+			raise
+		return _request(url, compressed=False, category="image")
+	if response.status == 206:
+		contentRange = response.getheader("Content-Range") or ""
+		if not contentRange.startswith("bytes " + str(offset) + "-"):
+			response.close()
+			return _request(url, compressed=False, category="image")
+	return response
+
+def _downloadFile(url, path):
+	"""	Streams "url" to a ".part" file next to "path", resuming it if it already
+		exists and the resource has not changed, and renames it to "path" once
+		complete.
+
+		Returns the response headers, or None if the file could not be created."""
+	partial = path + ".part"
+	response = _requestRemainder(url, partial)
+	try:
+		try:
+			download = open(partial, 'ab' if response.status == 206 else 'wb')
+		except (IOError, OSError):
+			return None
+		if response.status != 206:
+			_writeValidator(url, partial, response)
+		with download:
+			_copyResponse(response, download)
+	finally:
+		response.close()
+	_replaceFile(partial, path)
+	if os.path.exists(partial + ".validator"):
+		os.remove(partial + ".validator")
+	return response.headers
+
+def _hashFile(path):
+	"""	Returns the SHA-256 hex digest and the size of the file at "path"."""
+	digest = hashlib.sha256()
+	size = 0
+	with open(path, "rb") as hashedFile:
+		while True:
+			chunk = hashedFile.read(65536)
+			if not chunk:
+				return digest.hexdigest(), size
+			digest.update(chunk)
+			size += len(chunk)
+
+def _replaceFile(source, destination):
+	"""	Moves the file "source" over "destination" as atomically as the platform allows."""
+	if hasattr(os, "replace"):
+		os.replace(source, destination)
+	else:
+		# Python 2 on Windows cannot rename over an existing file.
+		if sys.platform.startswith("win") and os.path.exists(destination):
+			os.remove(destination)
+		os.rename(source, destination)
+
+class MetadataCache:
+
+	"""
+		A persistent cache of the info.0.json metadata of xkcd comics.
+
+		Once installed with :func:`setMetadataCache`, every :class:`Comic` consults
+		the cache before it goes to the network, so a warm process can construct
+		comic objects without any round trips at all. Entries are kept in memory
+		and, if a directory is given, also as one small JSON file per comic so
+		they survive restarts.
+
+		Published comics do not change, so by default entries never expire. If
+		"maxAge" (in seconds) is set, entries older than that are revalidated with
+		a conditional request using the ETag and Last-Modified headers from the
+		original response; a 304 reply refreshes the entry without a new download.
+
+		The cache holds at most "maxEntries" comics and, if set, at most "maxBytes"
+		bytes on disk; the least recently used entries are evicted first. The
+		"hits", "misses" and "revalidations" counters record how it is doing.
+	"""
+
+	def __init__(self, directory=None, maxEntries=10000, maxBytes=None, maxAge=None):
+		if directory is not None:
+			directory = os.path.abspath(os.path.expanduser(directory))
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+		self.directory = directory
+		self.maxEntries = maxEntries
+		self.maxBytes = maxBytes
+		self.maxAge = maxAge
+
+		self.hits = 0
+		self.misses = 0
+		self.revalidations = 0
+
+		self._lock = threading.Lock()
+		# Comic number -> entry, in least to most recently used order.
+		self._entries = collections.OrderedDict()
+		# Comic number -> size in bytes of the on-disk entry.
+		self._sizes = {}
+		self._totalBytes = 0
+		if directory is not None:
+			self._scanDirectory()
+
+	def __len__(self):
+		return len(self._sizes) if self.directory is not None else len(self._entries)
+
+	def __contains__(self, number):
+		return number in self._entries
+
+	def _path(self, number):
+		return os.path.join(self.directory, str(number) + ".json")
+
+	def _scanDirectory(self):
+		# Order the existing entries by modification time so that eviction
+		# carries on where the previous process left off.
+		found = []
+		for filename in os.listdir(self.directory):
+			name, extension = os.path.splitext(filename)
+			if extension != ".json" or not name.isdigit():
+				continue
+			stat = os.stat(os.path.join(self.directory, filename))
+			found.append((stat.st_mtime, int(name), stat.st_size))
+		found.sort()
+		for mtime, number, size in found:
+			self._entries[number] = None
+			self._sizes[number] = size
+			self._totalBytes += size
+
+	def _load(self, number):
+		try:
+			with open(self._path(number), "rb") as entryFile:
+				return json.loads(entryFile.read().decode("utf-8"))
+		except (IOError, OSError, ValueError):
+			return None
+
+	def _store(self, number, entry):
+		text = json.dumps(entry).encode("utf-8")
+		handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		try:
+			with os.fdopen(handle, "wb") as entryFile:
+				entryFile.write(text)
+			_replaceFile(temporary, self._path(number))
+		except (IOError, OSError):
+			if os.path.exists(temporary):
+				os.remove(temporary)
+			return
+		self._totalBytes += len(text) - self._sizes.get(number, 0)
+		self._sizes[number] = len(text)
+
+	def _forget(self, number):
+		self._entries.pop(number, None)
+		size = self._sizes.pop(number, None)
+		if size is not None:
+			self._totalBytes -= size
+			try:
+				os.remove(self._path(number))
+			except OSError:
+				pass
+
+	def _evict(self):
+		while len(self._entries) > 0:
+			tooMany = self.maxEntries is not None and len(self._entries) > self.maxEntries
+			tooBig = self.maxBytes is not None and self._totalBytes > self.maxBytes
+			if not (tooMany or tooBig):
+				break
+			oldest = next(iter(self._entries))
+			self._forget(oldest)
+
+	def _lookup(self, number):
+		# Returns the entry for "number", loading it from disk if needed, and
+		# marks it as the most recently used. Must be called with the lock held.
+		if number not in self._entries:
+			return None
+		entry = self._entries.pop(number)
+		if entry is None and self.directory is not None:
+			entry = self._load(number)
+			if entry is None:
+				self._forget(number)
+				return None
+		self._entries[number] = entry
+		return entry
+
+	def get(self, number):
+		"""	Returns the cached entry for comic "number" as a dictionary, or None
+			if the comic is not cached. The dictionary holds the decoded
+			info.0.json payload under "data", the validators under "etag" and
+			"lastModified", and the time it was fetched under "fetched".
+
+			A stale entry (see :func:`isStale`) is still returned, so its
+			validators can be used, but is counted as a miss."""
+		with self._lock:
+			entry = self._lookup(number)
+			if entry is None or self.isStale(entry):
+				self.misses += 1
+			else:
+				self.hits += 1
+			return entry
+
+	def isStale(self, entry):
+		"""	Returns True if "entry" is older than maxAge and should be revalidated."""
+		if self.maxAge is None:
+			return False
+		return time.time() - entry.get("fetched", 0) > self.maxAge
+
+	def put(self, number, data, etag=None, lastModified=None):
+		"""	Stores the decoded info.0.json payload "data" for comic "number",
+			along with the validators from the response that produced it."""
+		entry = {"data": data, "etag": etag, "lastModified": lastModified, "fetched": time.time()}
+		with self._lock:
+			self._entries.pop(number, None)
+			self._entries[number] = entry
+			if self.directory is not None:
+				self._store(number, entry)
+			self._evict()
+		return entry
+
+	def refresh(self, number):
+		"""	Marks the entry for comic "number" as freshly validated, e.g. after
+			the server answered a conditional request with 304 Not Modified."""
+		with self._lock:
+			entry = self._lookup(number)
+			if entry is None:
+				return
+			entry["fetched"] = time.time()
+			self.revalidations += 1
+			if self.directory is not None:
+				self._store(number, entry)
+
+	def getImageInfo(self, number, link):
+		"""	Returns the image information (see :func:`Comic.getImageInfo`) stored
+			for the image at "link" of comic "number", or None."""
+		with self._lock:
+			entry = self._lookup(number)
+			if entry is None:
+				return None
+			return entry.get("imageInfo", {}).get(link)
+
+	def putImageInfo(self, number, link, info):
+		"""	Stores the image information "info" for the image at "link" of comic
+			"number" alongside its metadata. Nothing is stored if the comic's
+			metadata is not cached; it is dropped when that metadata is replaced."""
+		with self._lock:
+			entry = self._lookup(number)
+			if entry is None:
+				return
+			entry.setdefault("imageInfo", {})[link] = info
+			if self.directory is not None:
+				self._store(number, entry)
+
+	def clear(self):
+		"""	Removes every entry from the cache, including those stored on disk."""
+		with self._lock:
+			for number in list(self._entries):
+				self._forget(number)
+
+	def stats(self):
+		"""	Returns a dictionary with the hit, miss and revalidation counters and
+			the number of entries and bytes currently held."""
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"revalidations": self.revalidations,
+			"entries": len(self),
+			"bytes": self._totalBytes,
+		}
+
+def setMetadataCache(directory=None, maxEntries=10000, maxBytes=None, maxAge=None):
+	"""	Installs a :class:`MetadataCache` that every :class:`Comic` will consult
+		before fetching its metadata from xkcd.com.
+
+		Arguments:
+			directory: where to persist the cache. If None, the cache is kept
+			in memory only and is lost when the process exits.
+
+			maxEntries: the maximum number of comics to hold, defaults to 10000.
+
+			maxBytes: the maximum size of the cache directory in bytes, or None
+			for no limit.
+
+			maxAge: how long, in seconds, an entry is trusted before it is revalidated
+			with a conditional request. The default of None never revalidates.
+
+		Returns the new cache. Pass a :class:`MetadataCache` object instead of a
+		directory to install it directly; call :func:`disableMetadataCache` to
+		go back to fetching every comic from the network."""
+	global metadataCache
+	if isinstance(directory, MetadataCache):
+		metadataCache = directory
+	else:
+		metadataCache = MetadataCache(directory, maxEntries, maxBytes, maxAge)
+	return metadataCache
+
+def disableMetadataCache():
+	"""	Uninstalls the metadata cache set with :func:`setMetadataCache`."""
+	global metadataCache
+	metadataCache = None
+
+class ImageCache:
+
+	"""
+		A content-addressed cache of comic images.
+
+		Every distinct image is stored once, under the SHA-256 digest of its
+		bytes, and an index maps each image URL (which names the image and
+		whether it is the 2x version) to a digest. Once installed with
+		:func:`setImageCache`, :func:`Comic.download` links or copies images out
+		of the cache instead of fetching them again, and :func:`Comic.getImageBytes`
+		returns them without touching the network.
+
+		If a directory is given, images are kept in its "objects" subdirectory
+		and survive restarts; otherwise they are kept in memory. The cache holds
+		at most "maxBytes" bytes of images, and the least recently used are
+		evicted first. The "hits" and "misses" counters record how it is doing.
+	"""
+
+	def __init__(self, directory=None, maxBytes=256 * 1024 * 1024):
+		if directory is not None:
+			directory = os.path.abspath(os.path.expanduser(directory))
+			if not os.path.exists(os.path.join(directory, "objects")):
+				os.makedirs(os.path.join(directory, "objects"))
+		self.directory = directory
+		self.maxBytes = maxBytes
+
+		self.hits = 0
+		self.misses = 0
+
+		self._lock = threading.Lock()
+		# Digest -> size in bytes, in least to most recently used order.
+		self._sizes = collections.OrderedDict()
+		# Digest -> image bytes, if the cache is kept in memory.
+		self._blobs = {}
+		# Image URL -> digest.
+		self._links = {}
+		self._totalBytes = 0
+		if directory is not None:
+			self._scanDirectory()
+
+	def __len__(self):
+		return len(self._sizes)
+
+	def __contains__(self, link):
+		digest = self._links.get(link)
+		return digest is not None and digest in self._sizes
+
+	def _objectPath(self, digest):
+		return os.path.join(self.directory, "objects", digest)
+
+	def _indexPath(self):
+		return os.path.join(self.directory, "index")
+
+	def _scanDirectory(self):
+		# As in MetadataCache, modification times give the eviction order.
+		found = []
+		for digest in os.listdir(os.path.join(self.directory, "objects")):
+			if len(digest) != 64:
+				continue
+			stat = os.stat(self._objectPath(digest))
+			found.append((stat.st_mtime, digest, stat.st_size))
+		found.sort()
+		for mtime, digest, size in found:
+			self._sizes[digest] = size
+			self._totalBytes += size
+
+		# The index is a log of "(digest) (URL)" lines; later lines win.
+		lines = 0
+		try:
+			with open(self._indexPath(), "rb") as indexFile:
+				for line in indexFile:
+					lines += 1
+					digest, _, link = line.decode("utf-8").rstrip("\n").partition(" ")
+					if digest in self._sizes:
+						self._links[link] = digest
+		except (IOError, OSError, ValueError):
+			pass
+		if lines > 2 * len(self._links) + 100:
+			self._rewriteIndex()
+
+	def _rewriteIndex(self):
+		handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		try:
+			with os.fdopen(handle, "wb") as indexFile:
+				for link, digest in self._links.items():
+					indexFile.write((digest + " " + link + "\n").encode("utf-8"))
+			_replaceFile(temporary, self._indexPath())
+		except (IOError, OSError):
+			if os.path.exists(temporary):
+				os.remove(temporary)
+
+	def _record(self, link, digest, size):
+		# Adds "digest" as the most recently used image and points "link" at it.
+		# Must be called with the lock held.
+		if digest not in self._sizes:
+			self._totalBytes += size
+		self._sizes.pop(digest, None)
+		self._sizes[digest] = size
+		if self._links.get(link) != digest:
+			self._links[link] = digest
+			if self.directory is not None:
+				try:
+					with open(self._indexPath(), "ab") as indexFile:
+						indexFile.write((digest + " " + link + "\n").encode("utf-8"))
+				except (IOError, OSError):
+					pass
+		self._evict()
+
+	def _forget(self, digest):
+		self._totalBytes -= self._sizes.pop(digest)
+		self._blobs.pop(digest, None)
+		for link in [link for link, linked in self._links.items() if linked == digest]:
+			del self._links[link]
+		if self.directory is not None:
+			try:
+				os.remove(self._objectPath(digest))
+			except OSError:
+				pass
+
+	def _evict(self):
+		while len(self._sizes) > 0 and self._totalBytes > self.maxBytes:
+			self._forget(next(iter(self._sizes)))
+
+	def _lookup(self, link):
+		# Returns the digest of the image cached for "link", marking it as the
+		# most recently used, or None. Must be called with the lock held.
+		digest = self._links.get(link)
+		if digest is None or digest not in self._sizes:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self._sizes[digest] = self._sizes.pop(digest)
+		if self.directory is not None:
+			try:
+				os.utime(self._objectPath(digest), None)
+			except OSError:
+				self.hits -= 1
+				self.misses += 1
+				self._forget(digest)
+				return None
+		return digest
+
+	def _damaged(self, digest):
+		# Files linked out of the cache can be edited in place, which changes the
+		# cached file too; such an entry is dropped and counted as a miss. Must
+		# be called with the lock held.
+		self.hits -= 1
+		self.misses += 1
+		self._forget(digest)
+
+	def getBytes(self, link):
+		"""	Returns the cached image for the URL "link" as bytes, or None if it is
+			not cached."""
+		with self._lock:
+			digest = self._lookup(link)
+			if digest is None or self.directory is None:
+				return self._blobs.get(digest)
+			with open(self._objectPath(digest), "rb") as objectFile:
+				data = objectFile.read()
+			if hashlib.sha256(data).hexdigest() != digest:
+				self._damaged(digest)
+				return None
+			return data
+
+	def copyTo(self, link, path):
+		"""	Puts the cached image for the URL "link" at "path", as a hard link
+			to the cached file where possible and as a copy otherwise. Returns
+			False, leaving "path" alone, if the image is not cached or the cached
+			file no longer matches its digest."""
+		with self._lock:
+			digest = self._lookup(link)
+			if digest is None:
+				return False
+			if self.directory is not None and _hashFile(self._objectPath(digest))[0] != digest:
+				self._damaged(digest)
+				return False
+			temporary = path + ".tmp"
+			if self.directory is None:
+				with open(temporary, "wb") as outputFile:
+					outputFile.write(self._blobs[digest])
+			else:
+				if os.path.exists(temporary):
+					os.remove(temporary)
+				try:
+					os.link(self._objectPath(digest), temporary)
+				except (AttributeError, OSError):
+					# No hard links on this platform, or across these file systems.
+					shutil.copyfile(self._objectPath(digest), temporary)
+			_replaceFile(temporary, path)
+			return True
+
+	def put(self, link, data):
+		"""	Stores "data", the image fetched from the URL "link", and returns its
+			digest. Images bigger than maxBytes are not stored."""
+		digest = hashlib.sha256(data).hexdigest()
+		if len(data) > self.maxBytes:
+			return digest
+		with self._lock:
+			if digest not in self._sizes:
+				if self.directory is None:
+					self._blobs[digest] = data
+				else:
+					handle, temporary = tempfile.mkstemp(dir=os.path.join(self.directory, "objects"))
+					with os.fdopen(handle, "wb") as objectFile:
+						objectFile.write(data)
+					_replaceFile(temporary, self._objectPath(digest))
+			self._record(link, digest, len(data))
+		return digest
+
+	def putFile(self, link, path):
+		"""	Stores a copy of the image at "path", fetched from the URL "link",
+			and returns its digest. The file is copied rather than linked, so
+			later changes to it do not reach the cache."""
+		if os.path.getsize(path) > self.maxBytes:
+			return _hashFile(path)[0]
+		if self.directory is None:
+			with open(path, "rb") as imageFile:
+				return self.put(link, imageFile.read())
+		# The digest is taken from the copy, in case the file changes meanwhile.
+		handle, temporary = tempfile.mkstemp(dir=os.path.join(self.directory, "objects"))
+		with os.fdopen(handle, "wb") as objectFile:
+			with open(path, "rb") as imageFile:
+				shutil.copyfileobj(imageFile, objectFile)
+		digest, size = _hashFile(temporary)
+		with self._lock:
+			if digest in self._sizes:
+				os.remove(temporary)
+			else:
+				_replaceFile(temporary, self._objectPath(digest))
+			self._record(link, digest, size)
+		return digest
+
+	def clear(self):
+		"""	Removes every image from the cache, including those stored on disk."""
+		with self._lock:
+			for digest in list(self._sizes):
+				self._forget(digest)
+			self._links = {}
+			if self.directory is not None and os.path.exists(self._indexPath()):
+				os.remove(self._indexPath())
+
+	def stats(self):
+		"""	Returns a dictionary with the hit and miss counters and the number of
+			images and bytes currently held."""
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"entries": len(self),
+			"bytes": self._totalBytes,
+		}
+
+def setImageCache(directory=None, maxBytes=256 * 1024 * 1024):
+	"""	Installs an :class:`ImageCache` that :func:`Comic.download` and
+		:func:`Comic.getImageBytes` will consult before fetching an image.
+
+		Arguments:
+			directory: where to keep the cached images. If None, they are kept
+			in memory only and are lost when the process exits.
+
+			maxBytes: the maximum size of the cached images in bytes, defaults
+			to 256 MiB.
+
+		Returns the new cache. Pass an :class:`ImageCache` object instead of a
+		directory to install it directly; call :func:`disableImageCache` to go
+		back to fetching every image from the network."""
+	global imageCache
+	if isinstance(directory, ImageCache):
+		imageCache = directory
+	else:
+		imageCache = ImageCache(directory, maxBytes)
+	return imageCache
+
+def disableImageCache():
+	"""	Uninstalls the image cache set with :func:`setImageCache`."""
+	global imageCache
+	imageCache = None
+
+def _downloadImage(link, path):
+	"""	Like :func:`_downloadFile`, but serves the image from the image cache if
+		there is one and it holds the image, and stores it there otherwise.
+		Concurrent downloads to the same path share one request.
+
+		Returns the response headers (an empty dictionary if the image came from
+		the cache), or None if the file could not be created."""
+	return _inFlight.do(("file", path), _downloadImageOnce, link, path)
+
+def _downloadImageOnce(link, path):
+	cache = imageCache
+	if cache is not None:
+		try:
+			if cache.copyTo(link, path):
+				_emitHit("image", link)
+				return {}
+		except (IOError, OSError):
+			return None
+	headers = _downloadFile(link, path)
+	if headers is not None and cache is not None:
+		cache.putFile(link, path)
+	return headers
+
+# The JPEG markers that start a frame, and so hold the image's dimensions.
+_jpegFrameMarkers = frozenset([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+
+def _parseImageHeader(data, complete=False):
+	"""	Reads the format, width and height of a PNG, GIF or JPEG image from
+		"data", the start of the image file.
+
+		Returns a dictionary with "format" ("png", "gif" or "jpeg"), "width" and
+		"height", or None if more of the file is needed. If "complete" is True,
+		"data" is the whole file, and a ValueError is raised instead."""
+	info = None
+	if data[:8] == b"\x89PNG\r\n\x1a\n":
+		if len(data) >= 24 and data[12:16] == b"IHDR":
+			width, height = struct.unpack(">II", data[16:24])
+			info = {"format": "png", "width": width, "height": height}
+	elif data[:6] in (b"GIF87a", b"GIF89a"):
+		if len(data) >= 10:
+			width, height = struct.unpack("<HH", data[6:10])
+			info = {"format": "gif", "width": width, "height": height}
+	elif data[:2] == b"\xff\xd8":
+		# Walk the segments until the start of the frame.
+		position = 2
+		while position + 4 <= len(data):
+			if data[position:position + 1] != b"\xff":
+				raise ValueError("Corrupt JPEG image")
+			marker = bytearray(data[position + 1:position + 2])[0]
+			if marker == 0xff:
+				position += 1
+				continue
+			if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+				position += 2
+				continue
+			length = struct.unpack(">H", data[position + 2:position + 4])[0]
+			if marker in _jpegFrameMarkers:
+				if position + 9 <= len(data):
+					height, width = struct.unpack(">HH", data[position + 5:position + 9])
+					info = {"format": "jpeg", "width": width, "height": height}
+				break
+			position += 2 + length
+	elif len(data) >= 8 or complete:
+		raise ValueError("Unknown image format")
+	if info is None and complete:
+		raise ValueError("Truncated image")
+	return info
+
+# How many bytes of an image to ask for first when reading its header; see _fetchImageInfo().
+imageInfoBytes = 4096
+
+def _fetchImageInfo(link):
+	"""	Reads the header of the image at "link" with as few bytes as possible,
+		using Range requests for imageInfoBytes bytes and then four times as
+		many each time more are needed. Returns what :func:`_parseImageHeader` does."""
+	data = b""
+	size = imageInfoBytes
+	while True:
+		headers = {"Range": "bytes=" + str(len(data)) + "-" + str(len(data) + size - 1)}
+		try:
+			response = _request(link, headers, compressed=False, category="image")
+		except urllib.HTTPError as error:
+			# 416 means there is nothing past what has been read already.
+			if error.code != 416 or len(data) == 0:
+				raise
+			return _parseImageHeader(data, True)
+		try:
+			if response.status != 206:
+				# The server ignored the Range header; read only what is needed.
+				data = b""
+				while True:
+					chunk = response.read(size)
+					data += chunk
+					info = _parseImageHeader(data, not chunk)
+					if info is not None:
+						return info
+			chunk = response.read()
+		finally:
+			response.close()
+		data += chunk
+		info = _parseImageHeader(data, len(chunk) < size)
+		if info is not None:
+			return info
+		size *= 4
+
+def _fetchImage(link, cache):
+	# Fetches the image at "link" into memory, adding it to "cache".
+	status, headers, data = _fetch(link, compressed=False, category="image")
+	if cache is not None:
+		cache.put(link, data)
+	return data
+
+class X2Resolver:
+
+	"""
+		Remembers which comics have a 2x scaled image.
+
+		:attr:`Comic.imageLinkx2` is only a guess at where the 2x image would be,
+		and many comics from 1063 on do not have one. The resolver checks the
+		guess with a HEAD request (see :func:`probe`, which checks many comics at
+		once) or learns the answer from the first attempt to download it, and
+		remembers it either way, so :func:`Comic.download` never asks for a 2x
+		image it knows is missing but falls back to the normal one straight away.
+
+		If "path" is given, the answers are also kept in that file, so they
+		survive restarts.
+	"""
+
+	def __init__(self, path=None):
+		if path is not None:
+			path = os.path.abspath(os.path.expanduser(path))
+		self.path = path
+		self._lock = threading.Lock()
+		# 2x image URL -> whether it exists.
+		self._known = {}
+		if path is not None and os.path.exists(path):
+			# The file is a log of "1 (URL)" and "0 (URL)" lines; later lines win.
+			with open(path, "rb") as resultsFile:
+				for line in resultsFile:
+					available, _, link = line.decode("utf-8").rstrip("\n").partition(" ")
+					self._known[link] = available == "1"
+
+	def get(self, link):
+		"""	Returns True if the 2x image at "link" is known to exist, False if it is
+			known not to, and None if it has not been checked."""
+		return self._known.get(link)
+
+	def record(self, link, available):
+		"""	Remembers whether the 2x image at "link" exists."""
+		with self._lock:
+			if self._known.get(link) == available:
+				return
+			self._known[link] = available
+			if self.path is not None:
+				with open(self.path, "ab") as resultsFile:
+					resultsFile.write(((available and "1 " or "0 ") + link + "\n").encode("utf-8"))
+
+	def isAvailable(self, comic):
+		"""	Returns True if "comic" has a 2x scaled image, checking with a HEAD
+			request if that is not known yet."""
+		link = comic.imageLinkx2
+		if link == comic.imageLink:
+			return False
+		available = self.get(link)
+		if available is None:
+			try:
+				_request(link, method="HEAD", compressed=False, category="image").close()
+				available = True
+			except urllib.HTTPError as error:
+				if error.code not in (403, 404, 410):
+					raise
+				available = False
+			self.record(link, available)
+		return available
+
+	def resolve(self, comic):
+		"""	Returns the link to the 2x scaled image of "comic" if it has one, and
+			the link to its normal image otherwise."""
+		return comic.imageLinkx2 if self.isAvailable(comic) else comic.imageLink
+
+	def probe(self, comics, maxWorkers=8):
+		"""	Checks which of "comics", an iterable of :class:`Comic` objects, have
+			a 2x scaled image, with up to "maxWorkers" HEAD requests at a time;
+			comics already checked cost nothing. Returns a list of the image links
+			to use for each comic, in order, as :func:`resolve` would. A comic that
+			could not be checked gets the exception raised instead."""
+		return [error if error is not None else link
+			for link, error in _runConcurrently(self.resolve, list(comics), maxWorkers)]
+
+	def clear(self):
+		"""	Forgets everything, including the file of answers if there is one."""
+		with self._lock:
+			self._known = {}
+			if self.path is not None and os.path.exists(self.path):
+				os.remove(self.path)
+
+# The resolver that remembers which comics have 2x images; see setX2Resolver().
+x2Resolver = X2Resolver()
+
+def setX2Resolver(path=None):
+	"""	Installs a new :class:`X2Resolver`, keeping its answers in the file at
+		"path" if one is given, and returns it. Pass an X2Resolver object to
+		install it directly."""
+	global x2Resolver
+	x2Resolver = path if isinstance(path, X2Resolver) else X2Resolver(path)
+	return x2Resolver
+
+def probeX2(comics, maxWorkers=8):
+	"""	Checks which of "comics" have a 2x scaled image, concurrently, and
+		returns the image link to use for each. See :func:`X2Resolver.probe`."""
+	return x2Resolver.probe(comics, maxWorkers)
+
+def getImageInfos(comics, maxWorkers=8, x2=False):
+	"""	Reads the image information of many comics concurrently; see
+		:func:`Comic.getImageInfo`. Returns a list with the information for each
+		of "comics", in order, or the exception raised for a comic that failed."""
+	return [error if error is not None else info
+		for info, error in _runConcurrently(lambda comic: comic.getImageInfo(x2), list(comics), maxWorkers)]
+
+def _withX2Fallback(comic, x2, fetch):
+	"""	Returns fetch(link) for the link of the comic's 2x scaled image if "x2"
+		is True and it may exist, and for the link of its normal image otherwise.
+		If the 2x image turns out to be missing, the normal one is fetched
+		instead, and :data:`x2Resolver` remembers what was learnt."""
+	link = comic.imageLinkx2
+	if not x2 or link == comic.imageLink:
+		return fetch(comic.imageLink)
+	resolver = x2Resolver
+	if resolver.get(link) is False:
+		return fetch(comic.imageLink)
+	try:
+		result = fetch(link)
+	except urllib.HTTPError as error:
+		if error.code not in (403, 404, 410):
+			raise
+		resolver.record(link, False)
+		return fetch(comic.imageLink)
+	resolver.record(link, True)
+	return result
+
+class LatestComicNum:
+
+	"""
+		Keeps track of the number of the latest xkcd comic so that bounds checks
+		in :func:`getComic` and :func:`getRandomComic` do not cost a request each.
+
+		The number is refetched once it is older than "ttl" seconds (by default
+		the module-level latestComicTTL). The refetch is a conditional request
+		against the ETag and Last-Modified headers of the previous response, so
+		if no new comic has been published the server replies 304 and nothing
+		is downloaded. Since the latest comic's info.0.json is also that comic's
+		metadata, it is handed to the metadata cache, if one is installed.
+
+		Concurrent lookups that need the number refetched share one request.
+		There is one shared instance, used by :func:`getLatestComicNum`; you
+		should not usually need to create your own.
+	"""
+
+	def __init__(self, ttl=None):
+		self.ttl = ttl
+		self.number = None
+		self.etag = None
+		self.lastModified = None
+		self.fetched = 0
+		self._lock = threading.Lock()
+
+	def isFresh(self):
+		"""	Returns True if the cached number can be used without a request."""
+		ttl = self.ttl if self.ttl is not None else latestComicTTL
+		return self.number is not None and time.time() - self.fetched < ttl
+
+	def get(self, refresh=False):
+		"""	Returns the number of the latest comic. If "refresh" is True, or the
+			cached number has expired, it is revalidated with xkcd.com first."""
+		if refresh or not self.isFresh():
+			_inFlight.do(self, self._update, time.time())
+		else:
+			_emitHit("latest", xkcdUrl + "info.0.json")
+		return self.number
+
+	def invalidate(self):
+		"""	Forgets the cached number, so the next lookup must ask xkcd.com."""
+		with self._lock:
+			self.fetched = 0
+
+	def _update(self, asked):
+		with self._lock:
+			# Another thread may have fetched the number since it was asked for.
+			if self.fetched < asked:
+				self._fetch()
+
+	def _fetch(self):
+		headers = {}
+		if self.number is not None:
+			if self.etag:
+				headers["If-None-Match"] = self.etag
+			if self.lastModified:
+				headers["If-Modified-Since"] = self.lastModified
+		status, responseHeaders, body = _fetch(xkcdUrl + "info.0.json", headers, category="latest")
+		self.fetched = time.time()
+		if status == 304 and self.number is not None:
+			return
+		xkcdJSON = json.loads(body.decode())
+		self.number = xkcdJSON['num']
+		self.etag = responseHeaders.get("ETag")
+		self.lastModified = responseHeaders.get("Last-Modified")
+		if metadataCache is not None:
+			metadataCache.put(self.number, xkcdJSON)
+
+# The shared latest comic number, used by getLatestComicNum().
+latestComicNum = LatestComicNum()
+
+def _runConcurrently(function, items, maxWorkers):
+	"""	Calls "function" on every element of "items", using a pool of at most
+		"maxWorkers" threads.
+
+		Returns a list, in the same order as "items", of (result, error) tuples;
+		error is None if the call succeeded and the exception it raised if not."""
+	items = list(items)
+	results = [None] * len(items)
+	position = [0]
+	lock = threading.Lock()
+	# The workers inherit the caller's timeouts and deadline.
+	callerTimeouts = _timeoutOverrides()
+
+	def worker():
+		_local.timeouts = callerTimeouts
+		while True:
+			with lock:
+				index = position[0]
+				if index >= len(items):
+					return
+				position[0] += 1
+			try:
+				results[index] = (function(items[index]), None)
+			except Exception as error:
+				results[index] = (None, error)
+
+	threads = []
+	for i in range(max(1, min(maxWorkers, len(items)))):
+		thread = threading.Thread(target=worker)
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	return results
+
+def _getComicData(number):
+	"""	Returns the decoded info.0.json payload for comic "number", consulting
+		the snapshot and metadata cache first if they have been installed.
+		Concurrent fetches of the same comic share one request."""
+	url = xkcdUrl + str(number) + "/info.0.json"
+	if snapshot is not None and number <= snapshot.latestComicNum:
+		data = snapshot.getComicData(number)
+		if data is None:
+			raise urllib.HTTPError(url, 404, "Not in snapshot", {}, None)
+		_emitHit("metadata", url)
+		return data
+
+	cache = metadataCache
+	headers = {}
+	entry = None
+	if cache is not None:
+		entry = cache.get(number)
+		if entry is not None:
+			if not cache.isStale(entry):
+				_emitHit("metadata", url)
+				return entry["data"]
+			if entry.get("etag"):
+				headers["If-None-Match"] = entry["etag"]
+			if entry.get("lastModified"):
+				headers["If-Modified-Since"] = entry["lastModified"]
+
+	def fetch():
+		status, responseHeaders, body = _fetch(url, headers, category="metadata")
+		if status == 304 and entry is not None:
+			cache.refresh(number)
+			return entry["data"]
+		data = json.loads(body.decode())
+		if cache is not None:
+			cache.put(number, data, responseHeaders.get("ETag"), responseHeaders.get("Last-Modified"))
+		return data
+	return _inFlight.do(url, fetch)
+
+class WhatIf(object):
 
 	"""
 		Class representing an xkcd What If article.
@@ -57,10 +1830,19 @@ class WhatIf:
 		interested in.
 	"""
 
+	# Slots keep WhatIf objects small; the link is worked out from the number.
+	__slots__ = ("number", "title")
+
 	def __init__(self):
 		self.number = -1
 		self.title = ''
-		self.link = ''
+
+	@property
+	def link(self):
+		"""	The link to the article on the What If website."""
+		if self.number == -1:
+			return ''
+		return whatIfUrl + str(self.number) + "/"
 
 	def __str__(self):
 		return "What If object for " + self.link
@@ -113,6 +1895,9 @@ class WhatIfArchiveParser(HTMLParser.HTMLParser):
 		self.whatifs = {}
 		self.currentWhatIf = None
 
+		# What-ifs parsed since iterWhatIfs last yielded.
+		self.parsed = []
+
 		# Parsing metadata
 		self.parsingWhatIf = False
 		self.seenATag = 0
@@ -144,20 +1929,29 @@ class WhatIfArchiveParser(HTMLParser.HTMLParser):
 					except:
 						num = -1
 					self.currentWhatIf.number = num
-					self.currentWhatIf.link = "https:" + link
 
 	def handle_data(self, data):
 		# Some cruder parsing to pick out the data.
 		if self.parsingWhatIf:
 			if self.seenATag == 2:
-				self.currentWhatIf.title = data
+				# The title may arrive in pieces, e.g. if it straddles two chunks
+				# passed to feed or contains an entity.
+				self.currentWhatIf.title += data
+
+	def handle_entityref(self, name):
+		self.handle_data(_unescapeHTML("&" + name + ";"))
+
+	def handle_charref(self, name):
+		self.handle_data(_unescapeHTML("&#" + name + ";"))
 
 	def handle_endtag(self, tag):
 		# When we encounter the final </div>, stop parsing these.
 		if tag == "div" and self.parsingWhatIf:
 			self.parsingWhatIf = False
+			# A new WhatIf is made for every entry, so it can be kept as it is.
 			if self.currentWhatIf.number != -1:
-				self.whatifs[self.currentWhatIf.number] = copy.copy(self.currentWhatIf)
+				self.whatifs[self.currentWhatIf.number] = self.currentWhatIf
+				self.parsed.append(self.currentWhatIf)
 
 		# When we encounter the final </a>, reset seen counter to make handle_data
 		# not do anything.
@@ -172,7 +1966,30 @@ class WhatIfArchiveParser(HTMLParser.HTMLParser):
 			If for some reason the parsing has failed, the dictionary will be empty."""
 		return self.whatifs
 
-class Comic:
+	def iterWhatIfs(self, stream, chunkSize=16384):
+		"""	Reads HTML from the file-like object "stream" in chunks of "chunkSize"
+			bytes, feeding each one to the parser as soon as it has been read, and
+			yields each :class:`WhatIf` object as soon as its archive entry has
+			been parsed. The bytes are decoded as UTF-8 incrementally, so a
+			character split across two chunks is handled correctly.
+
+			Once the generator is exhausted, :func:`getWhatIfs` returns every
+			What If that was parsed."""
+		decoder = codecs.getincrementaldecoder("utf-8")()
+		while True:
+			chunk = stream.read(chunkSize)
+			text = decoder.decode(chunk, not chunk)
+			if text:
+				self.feed(text)
+			if not chunk:
+				self.close()
+			parsed, self.parsed = self.parsed, []
+			for whatif in parsed:
+				yield whatif
+			if not chunk:
+				return
+
+class Comic(object):
 
 	"""	Class representing a single xkcd comic. These can be produced via number of
 		ways; if you know the number of the comic you want to query, you can just
@@ -181,47 +1998,125 @@ class Comic:
 
 		There are also helper functions available to get the latest comic (:func:`getLatestComic`)
 		and a random comic(:func:`getRandomComic`) as comic objects.
+
+		If constructed with lazy=True, no request is made until one of the fields
+		that needs the comic's metadata (title, altText, imageLink, imageLinkx2 or
+		imageName) is first read; the number, link and explanation are available
+		for free. The metadata is then fetched once, even if several threads ask
+		for it at the same time.
 	"""
 
-	def __init__(self, number):
-		global xkcdUrl, imageUrl
+	# Slots keep Comic objects small when many are held in memory. The links
+	# are worked out from the number and image name when they are read; the
+	# image link is only stored if it does not live under imageUrl.
+	__slots__ = ("number", "title", "altText", "imageName", "_imageLink", "date",
+		"transcript", "news", "externalLink", "_loadLock", "_asciiCache")
+
+	# The attributes that are only available once the metadata has been fetched.
+	_lazyFields = ("title", "altText", "imageName", "_imageLink", "date", "transcript",
+		"news", "externalLink")
+
+	def __init__(self, number, lazy=False):
 		if type(number) is str and number.isdigit():
 			number = int(number)
 		self.number = number
+		self._loadLock = None
+		self._asciiCache = None
 		if number <= 0:
-			self.link = "Invalid comic"
 			return
 
+		if lazy:
+			self._loadLock = threading.Lock()
+		else:
+			self._load()
+
+	def __getattr__(self, name):
+		# Only called for attributes that have not been set yet, so this is
+		# where a lazy comic fetches its metadata.
+		if name in Comic._lazyFields and self._loadLock is not None:
+			with self._loadLock:
+				try:
+					return object.__getattribute__(self, name)
+				except AttributeError:
+					self._load()
+			return object.__getattribute__(self, name)
+		raise AttributeError(name)
+
+	def __getstate__(self):
+		# The lock cannot be pickled or copied; __setstate__ makes a new one if
+		# the metadata has not been loaded yet.
+		state = {}
+		for name in Comic.__slots__:
+			if name == "_loadLock":
+				continue
+			try:
+				state[name] = object.__getattribute__(self, name)
+			except AttributeError:
+				pass
+		return state
+
+	def __setstate__(self, state):
+		for name, value in state.items():
+			setattr(self, name, value)
+		self._loadLock = None
+		if self.number > 0 and any(name not in state for name in Comic._lazyFields):
+			self._loadLock = threading.Lock()
+
+	@property
+	def link(self):
 		"""	The link to the comic on the xkcd website."""
-		self.link = xkcdUrl + str(number)
-
-		#Get data from the JSON interface
-		jsonString = self.link + "/info.0.json"
-		xkcd = urllib.urlopen(jsonString).read()
-		xkcdData = json.loads(xkcd.decode())
+		if self.number <= 0:
+			return "Invalid comic"
+		return xkcdUrl + str(self.number)
+
+	@property
+	def imageLink(self):
+		"""	The URL of the comic's image."""
+		imageLink = self._imageLink
+		if imageLink is None:
+			return imageUrl + self.imageName
+		return imageLink
+
+	@property
+	def imageLinkx2(self):
+		"""	The URL of the 2x scaled version of the comic's image, if applicable."""
+		imageLink = self.imageLink
+		# Work out what the 2x url would be, if applicable. Not every comic has
+		# one; see X2Resolver.
+		if self.number >= 1063:
+			parsed = urlparse(imageLink)
+			filename, extension = os.path.splitext(parsed.path)
+			return parsed.scheme + "://" + parsed.netloc + filename + "_2x" + extension
+		return imageLink
+
+	def _load(self, xkcdData=None):
+		global imageUrl
+		number = self.number
+
+		#Get data from the JSON interface, or the metadata cache if there is one.
+		if xkcdData is None:
+			xkcdData = _getComicData(number)
 		self.title = xkcdData['safe_title']
 		self.altText = xkcdData['alt']
-		self.imageLink = xkcdData['img']
-
-		# Work out what the 2x url would be, if applicable
-		if number >= 1063:
-			parsed = urlparse(self.imageLink)
-			filename = parsed.path.split('.')[0] + "_2x"
-			extension = parsed.path.split('.')[1]
-			self.imageLinkx2 = parsed.scheme + "://" + parsed.netloc + filename + "." + extension
-		else:
-			self.imageLinkx2 = self.imageLink
-
-		# This may no longer be necessary.
-#		if sys.version_info[0] >= 3:
-#			self.title = str(self.title, encoding='UTF-8')
-#			self.altText = str(self.altText, encoding='UTF-8')
-#			self.imageLink = str(self.imageLink, encoding='UTF-8')
+		self.transcript = xkcdData.get('transcript', '')
+		self.news = xkcdData.get('news', '')
+		self.externalLink = xkcdData.get('link', '')
+		try:
+			self.date = datetime.date(int(xkcdData['year']), int(xkcdData['month']), int(xkcdData['day']))
+		except (KeyError, ValueError):
+			self.date = None
+		imageLink = xkcdData['img']
 
 		#Get the image filename
 		offset = len(imageUrl)
-		index = self.imageLink.find(imageUrl)
-		self.imageName = self.imageLink[index + offset:]
+		index = imageLink.find(imageUrl)
+		self.imageName = imageLink[index + offset:]
+		if imageUrl + self.imageName == imageLink:
+			self._imageLink = None
+		else:
+			self._imageLink = imageLink
+		# Every field is set now, so the lock is no longer needed.
+		self._loadLock = None
 
 	def __str__(self):
 		return "Comic object for " + self.link
@@ -245,20 +2140,27 @@ class Comic:
 		You should do your best to not need to use this routine and prefer :func:`getTitle`
 		wherever possible.
 		"""
-		asciiTitle = convertToAscii(self.title)
-		return asciiTitle
+		return self._ascii("title")
 
 	def getAsciiAltText(self):
 		"""	Returns the ASCII-formatted version of the comic's alt-text. See
 		:func:`getAsciiTitle` and :func:`getAltText` for more information."""
-		asciiAltText = convertToAscii(self.altText)
-		return asciiAltText
+		return self._ascii("altText")
 
 	def getAsciiImageLink(self):
 		"""	Returns the ASCII-formatted version of the link to the comic's
 			image. See :func:`getAsciiTitle` and :func:`getImageLink` for more information."""
-		asciiImageLink = convertToAscii(self.imageLink)
-		return asciiImageLink
+		return self._ascii("imageLink")
+
+	def _ascii(self, name):
+		# The ASCII versions are remembered, since the fields never change.
+		if self._asciiCache is None:
+			self._asciiCache = {}
+		converted = self._asciiCache.get(name)
+		if converted is None:
+			converted = convertToAscii(getattr(self, name))
+			self._asciiCache[name] = converted
+		return converted
 
 	def getAltText(self):
 		"""	Returns the alt-text of the comic (the text that appears when one places
@@ -273,6 +2175,24 @@ class Comic:
 		"""	Returns the filename of the comic's image as a UTF-8 formatted Unicode string."""
 		return self.imageName
 
+	def getDate(self):
+		"""	Returns the date the comic was published as a datetime.date object,
+			or None if it is not known."""
+		return self.date
+
+	def getTranscript(self):
+		"""	Returns the transcript of the comic, which is empty for most recent comics."""
+		return self.transcript
+
+	def getNews(self):
+		"""	Returns the news text shown under the comic, usually empty."""
+		return self.news
+
+	def getExternalLink(self):
+		"""	Returns the link the comic's image points at (the "link" field of the
+			xkcd JSON API), usually empty."""
+		return self.externalLink
+
 	def getExplanation(self):
 		"""	Returns an explainxkcd link for the comic. explainxkcd is a wiki with community
 			contributed explanations for xkcd comics; this function produces the URL for
@@ -285,14 +2205,72 @@ class Comic:
 			web browser."""
 		webbrowser.open_new_tab(self.link)
 
-	def download(self, output="", outputFile="", silent=True, x2=False):
+	def getImageBytes(self, x2=False, deadline=None):
+		"""	Returns the comic's image (or its 2x scaled version, if "x2" is True
+			and there is one) as bytes. If an image cache is installed (see
+			:func:`setImageCache`), the image is served from it when it can be,
+			and stored in it when not. See :func:`download` for "deadline"."""
+		with timeouts(deadline=deadline):
+			return _withX2Fallback(self, x2, self._getImageBytes)
+
+	def getImageInfo(self, x2=False):
+		"""	Returns the format and dimensions of the comic's image (or its 2x scaled
+			version, if "x2" is True and there is one), as a dictionary with
+			"format" ("png", "gif" or "jpeg"), "width" and "height".
+
+			Only the start of the image is downloaded, with an HTTP Range request;
+			usually a few kilobytes are enough. If a metadata cache is installed
+			(see :func:`setMetadataCache`), the result is kept with the comic's
+			metadata, and an image already in the image cache is read from there.
+			See :func:`getImageInfos` to do this for many comics at once."""
+		return _withX2Fallback(self, x2, self._getImageInfo)
+
+	def _getImageInfo(self, link):
+		cache = metadataCache
+		if cache is not None:
+			info = cache.getImageInfo(self.number, link)
+			if info is not None:
+				_emitHit("image", link)
+				return dict(info)
+		data = None
+		if imageCache is not None and link in imageCache:
+			data = imageCache.getBytes(link)
+		if data is not None:
+			info = _parseImageHeader(data, True)
+		else:
+			info = _inFlight.do(("info", link), _fetchImageInfo, link)
+		if cache is not None:
+			cache.putImageInfo(self.number, link, info)
+		return dict(info)
+
+	def _getImageBytes(self, link):
+		cache = imageCache
+		if cache is not None:
+			data = cache.getBytes(link)
+			if data is not None:
+				_emitHit("image", link)
+				return data
+		return _inFlight.do(link, _fetchImage, link, cache)
+
+	def download(self, output="", outputFile="", silent=True, x2=False, deadline=None):
 		"""	Downloads the image of the comic onto your computer.
 
+			The image is streamed to disk in chunks, so memory use does not depend
+			on its size. It is first written to a file with a ".part" suffix, which
+			is renamed into place once complete; if a download is interrupted, the
+			next call resumes from the end of the partial file with an HTTP Range
+			request, provided the image's ETag or Last-Modified date, recorded in a
+			".part.validator" file alongside, still matches. If an image cache is installed (see :func:`setImageCache`),
+			an image it holds is hard-linked or copied from it instead, and a
+			downloaded image is added to it.
+
 			Arguments:
 				output: the output directory where comics will be downloaded to. The
 				default argument for 'output is the empty string; if the empty
 				string is passed, it defaults to a "Downloads" directory in your home folder
-				(this directory will be created if it does not exist).
+				(this directory will be created if it does not exist). A writable
+				file object (e.g. an open file or an io.BytesIO) may be passed instead,
+				in which case the image is written to it and outputFile is ignored.
 
 				outputFile: the filename that will be written. If the empty string
 				is passed, outputFile will default to a string of the form xkcd-(comic number)-(image filename),
@@ -301,48 +2279,250 @@ class Comic:
 				silent: boolean, defaults to True. If set to False, an error will be printed
 				to standard output should the provided integer argument not be valid.
 
-				x2: boolean, defaults to False. If set to True, will attempt to download
-				the 2x scaled version of the comic.
+				x2: boolean, defaults to False. If set to True, will download the 2x
+				scaled version of the comic if there is one, and the normal version
+				otherwise (see :class:`X2Resolver`).
+
+				deadline: how long, in seconds, the download may take before it
+				raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
+			Returns the path to the downloaded file (or the file object it was written
+			to), or an empty string in the event of failure."""
+		with timeouts(deadline=deadline):
+			if hasattr(output, "write"):
+				if imageCache is not None:
+					output.write(self.getImageBytes(x2))
+					return output
+				def copy(link):
+					response = _request(link, compressed=False, category="image")
+					try:
+						_copyResponse(response, output)
+					finally:
+						response.close()
+				_withX2Fallback(self, x2, copy)
+				return output
+
+			#Process optional input to work out where the dowload will go and what it'll be called
+			if output != "":
+				output = os.path.abspath(os.path.expanduser(output))
+			if output == "" or not os.path.exists(output):
+				output = os.path.expanduser(os.path.join("~", "Downloads"))
+				# Create ~/Downloads if it doesn't exist, since this is the default path.
+				if not os.path.exists(output):
+					os.mkdir(output)
+			if outputFile == "":
+				outputFile = "xkcd-" + str(self.number) + "-" + self.imageName
+
+			output = os.path.join(output, outputFile)
+			if _withX2Fallback(self, x2, lambda link: _downloadImage(link, output)) is None:
+				if not silent:
+					print("Unable to make file " + output)
+				return ""
+			return output
+
+class ComicCollection(object):
 
-			Returns the path to the downloaded file, or an empty string in the event
-			of failure."""
-		if x2:
-			image = urllib.urlopen(self.imageLinkx2).read()
-		else:
-			image = urllib.urlopen(self.imageLink).read()
-
-		#Process optional input to work out where the dowload will go and what it'll be called
-		if output != "":
-			output = os.path.abspath(os.path.expanduser(output))
-		if output == "" or not os.path.exists(output):
-			output = os.path.expanduser(os.path.join("~", "Downloads"))
-			# Create ~/Downloads if it doesn't exist, since this is the default path.
-			if not os.path.exists(output):
-				os.mkdir(output)
-		if outputFile == "":
-			outputFile = "xkcd-" + str(self.number) + "-" + self.imageName
-
-		output = os.path.join(output, outputFile)
-		try:
-			download = open(output, 'wb')
-		except:
-			if not silent:
-				print("Unable to make file " + output)
-			return ""
-		download.write(image)
-		download.close()
-		return output
+	"""
+		A compact, read-mostly collection of comic metadata, for holding the
+		whole xkcd corpus in memory.
+
+		Rather than keeping a :class:`Comic` object per comic, the collection
+		packs each comic's text fields (title, alt-text, image name, date and so
+		on) into a single UTF-8 buffer and keeps the comic numbers and buffer offsets in arrays, so each
+		comic costs little more than its text. Comic objects are produced on
+		demand when a comic is looked up or iterated over; none of this needs
+		the network.
+
+		Use it like a read-only dictionary keyed by comic number:
+
+			collection = ComicCollection(xkcd.getComics(range(1, 101)))
+			comic = collection[42]
+	"""
+
+	# Separates the fields of one comic in the buffer.
+	_separator = u"\x00"
+
+	def __init__(self, comics=()):
+		self._numbers = array.array("l")
+		self._offsets = array.array("L", [0])
+		self._buffer = bytearray()
+		# Image links that cannot be worked out from imageUrl, by comic number.
+		self._imageLinks = {}
+		# Numbers added out of order since the collection was last sorted; they
+		# are at the end of the arrays, after the sorted ones.
+		self._unsorted = set()
+		for comic in comics:
+			self.add(comic)
+
+	def __len__(self):
+		return len(self._numbers)
+
+	def __contains__(self, number):
+		return self._find(number) is not None
+
+	def __iter__(self):
+		self._sort()
+		for index in range(len(self._numbers)):
+			yield self._comic(index)
+
+	def __getitem__(self, number):
+		index = self._find(number)
+		if index is None:
+			raise KeyError(number)
+		return self._comic(index)
+
+	def add(self, comic):
+		"""	Adds the metadata of the :class:`Comic` "comic" to the collection.
+			Invalid comics and exceptions (as returned by :func:`getComics`) are
+			ignored, and a comic already in the collection is not added twice."""
+		if not isinstance(comic, Comic) or comic.number <= 0 or self._added(comic.number):
+			return
+		date = comic.date.isoformat() if comic.date is not None else u""
+		record = self._separator.join((comic.title, comic.altText, comic.imageName, date,
+			comic.transcript, comic.news, comic.externalLink))
+		self._buffer.extend(record.encode("utf-8"))
+		if self._unsorted or (len(self._numbers) > 0 and comic.number < self._numbers[-1]):
+			self._unsorted.add(comic.number)
+		self._numbers.append(comic.number)
+		self._offsets.append(len(self._buffer))
+		if comic._imageLink is not None:
+			self._imageLinks[comic.number] = comic._imageLink
+
+	def numbers(self):
+		"""	Returns a list of the numbers of every comic in the collection, in order."""
+		self._sort()
+		return list(self._numbers)
+
+	def _added(self, number):
+		# Checks for a number without sorting, so adding many comics out of
+		# order is not quadratic.
+		if number in self._unsorted:
+			return True
+		end = len(self._numbers) - len(self._unsorted)
+		index = bisect.bisect_left(self._numbers, number, 0, end)
+		return index < end and self._numbers[index] == number
+
+	def _sort(self):
+		# Comics added out of order are put in order the next time they are looked up.
+		if not self._unsorted:
+			return
+		records = sorted(zip(self._numbers, self._offsets[:-1], self._offsets[1:]))
+		buffer = bytearray()
+		self._numbers = array.array("l")
+		self._offsets = array.array("L", [0])
+		for number, start, end in records:
+			buffer.extend(self._buffer[start:end])
+			self._numbers.append(number)
+			self._offsets.append(len(buffer))
+		self._buffer = buffer
+		self._unsorted = set()
+
+	def _find(self, number):
+		self._sort()
+		index = bisect.bisect_left(self._numbers, number)
+		if index < len(self._numbers) and self._numbers[index] == number:
+			return index
+		return None
+
+	def _comic(self, index):
+		start, end = self._offsets[index], self._offsets[index + 1]
+		fields = self._buffer[start:end].decode("utf-8").split(self._separator)
+		title, altText, imageName, date, transcript, news, externalLink = fields
+		comic = Comic(self._numbers[index], lazy=True)
+		comic.title = title
+		comic.altText = altText
+		comic.imageName = imageName
+		comic.date = None
+		if date:
+			comic.date = datetime.date(*[int(part) for part in date.split("-")])
+		comic.transcript = transcript
+		comic.news = news
+		comic.externalLink = externalLink
+		comic._imageLink = self._imageLinks.get(comic.number)
+		# Every field is set, so the comic does not need a lock to load them.
+		comic._loadLock = None
+		return comic
+
+class DateIndex(object):
+
+	"""
+		An index of comics by publication date, for questions like "which comics
+		were published in March 2014?" or "which comic came out on 2016-04-01?".
+
+		The dates are kept sorted, so lookups are binary searches rather than
+		scans. Comics can be added in any order. Build one from :class:`Comic`
+		objects you already have, or with :func:`fromArchive` from every comic
+		published so far (which is cheap with a metadata cache or snapshot).
+	"""
+
+	def __init__(self, comics=()):
+		# Parallel arrays of date ordinals and comic numbers, sorted by date.
+		self._dates = array.array("l")
+		self._numbers = array.array("l")
+		for comic in comics:
+			self.add(comic)
+
+	def __len__(self):
+		return len(self._numbers)
+
+	@classmethod
+	def fromArchive(cls, maxWorkers=8):
+		"""	Returns a DateIndex of every comic published so far, fetching their
+			metadata with :func:`getComics`."""
+		return cls(getComics(range(1, getLatestComicNum() + 1), maxWorkers))
+
+	def add(self, comic):
+		"""	Adds the :class:`Comic` "comic" to the index. Invalid comics, comics
+			without a date and exceptions (as returned by :func:`getComics`) are
+			ignored."""
+		if not isinstance(comic, Comic) or comic.number <= 0 or comic.date is None:
+			return
+		date = comic.date.toordinal()
+		# Comics published on the same date are kept in number order.
+		first = bisect.bisect_left(self._dates, date)
+		last = bisect.bisect_right(self._dates, date)
+		index = first + bisect.bisect_left(self._numbers[first:last], comic.number)
+		if index < last and self._numbers[index] == comic.number:
+			return
+		self._dates.insert(index, date)
+		self._numbers.insert(index, comic.number)
+
+	def between(self, start, end):
+		"""	Returns the numbers of the comics published from the date "start" to
+			the date "end" (both datetime.date objects), inclusive, in order."""
+		first = bisect.bisect_left(self._dates, start.toordinal())
+		last = bisect.bisect_right(self._dates, end.toordinal())
+		return list(self._numbers[first:last])
+
+	def on(self, date):
+		"""	Returns the number of the comic published on "date", or None if
+			there was none. If there were several, the first is returned."""
+		numbers = self.between(date, date)
+		if len(numbers) == 0:
+			return None
+		return numbers[0]
 
 # Functions that work on Comics.
 
-def getLatestComicNum():
+def getLatestComicNum(refresh=False, deadline=None):
 	"""	Uses the xkcd JSON API to look up the number of the latest xkcd comic.
 
+		The number is remembered for latestComicTTL seconds (five minutes by
+		default) and then revalidated with a conditional request; see
+		:class:`LatestComicNum`.
+
+		Arguments:
+			refresh: boolean, defaults to False. If set to True, xkcd.com is asked
+			for the latest number even if the remembered one has not expired.
+
+			deadline: how long, in seconds, the whole call may take before it
+			raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
 		Returns that number as an integer."""
-	xkcd = urllib.urlopen("https://xkcd.com/info.0.json").read()
-	xkcdJSON = json.loads(xkcd.decode())
-	number = xkcdJSON['num']
-	return number
+	with timeouts(deadline=deadline):
+		if snapshot is not None:
+			return snapshot.latestComicNum
+		return latestComicNum.get(refresh)
 
 def getLatestComic():
 	"""	Produces a :class:`Comic` object for the latest xkcd comic. This function
@@ -351,7 +2531,20 @@ def getLatestComic():
 
 		Returns the resulting comic object."""
 	number = getLatestComicNum()
-	return Comic(number)
+	comic = Comic(number)
+	if prefetcher is not None:
+		prefetcher.served(number)
+	return comic
+
+def _randomComicNumber(numComics):
+	# Returns a random comic number up to "numComics". With a snapshot installed,
+	# only the comics it holds are drawn, since it may leave some out.
+	current = snapshot
+	if current is not None:
+		numbers = current.getComicNumbers()
+		if numbers:
+			return random.choice(numbers)
+	return random.randint(1, numComics)
 
 def getRandomComic():
 	"""	Produces a :class:`Comic` object for a random xkcd comic. Uses the
@@ -361,10 +2554,18 @@ def getRandomComic():
 		Returns the resulting comic object."""
 	random.seed()
 	numComics = getLatestComicNum()
-	number = random.randint(1, numComics)
-	return Comic(number)
-
-def getComic(number, silent=True):
+	number = None
+	if prefetcher is not None:
+		# Use the pick the prefetcher has drawn, and warmed, in advance.
+		number = prefetcher.takeRandom(numComics)
+	if number is None:
+		number = _randomComicNumber(numComics)
+	comic = Comic(number)
+	if prefetcher is not None:
+		prefetcher.served(number)
+	return comic
+
+def getComic(number, silent=True, lazy=False, deadline=None):
 	"""	Produces a :class:`Comic` object with index equal to the provided argument.
 		Prints an error in the event of a failure (i.e. the number is less than zero
 		or greater than the latest comic number) and returns an empty Comic object.
@@ -375,37 +2576,608 @@ def getComic(number, silent=True):
 			silent: boolean, defaults to True. If set to False, an error will be printed
 			to standard output should the provided integer argument not be valid.
 
+			lazy: boolean, defaults to False. If set to True, the comic's metadata is
+			not fetched until it is first needed; see :class:`Comic`.
+
+			deadline: how long, in seconds, the whole call may take before it
+			raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
 		Returns the resulting Comic object for the provided index if successful,
 		or a Comic object with -1 as the index if not."""
-	numComics = getLatestComicNum()
-	
-	if type(number) is str and number.isdigit():
-		number = int(number)
-	if number > numComics or number <= 0:
-		if not silent:
-			print("Error: You have requested an invalid comic.")
-		return Comic(-1)
-	return Comic(number)
+	with timeouts(deadline=deadline):
+		if type(number) is str and number.isdigit():
+			number = int(number)
+		valid = number > 0
+		if valid:
+			lastChecked = latestComicNum.fetched
+			numComics = getLatestComicNum()
+			# A comic may have been published since the latest number was cached.
+			if number > numComics and latestComicNum.fetched == lastChecked:
+				numComics = getLatestComicNum(refresh=True)
+			valid = number <= numComics
+		if not valid:
+			if not silent:
+				print("Error: You have requested an invalid comic.")
+			return Comic(-1)
+		comic = Comic(number, lazy)
+		if prefetcher is not None:
+			prefetcher.served(number)
+		return comic
+
+def getComics(numbers, maxWorkers=8, silent=True, deadline=None):
+	"""	Produces a list of :class:`Comic` objects for many comics at once,
+		fetching their metadata concurrently rather than one after another.
+
+		The latest comic number is looked up once for the whole batch. As with
+		:func:`getComic`, invalid numbers produce a Comic object with -1 as the
+		index. A comic that cannot be fetched does not abort the batch; instead
+		the exception raised while fetching it is placed in the list.
+
+		Arguments:
+			numbers: an iterable (e.g. a list or a range) of integers or strings
+			that represent numbers, the indices of the comics in question.
+
+			maxWorkers: the maximum number of comics to fetch at once, defaults to 8.
+
+			silent: boolean, defaults to True. If set to False, an error will be printed
+			to standard output for every invalid number or failed fetch.
+
+			deadline: how long, in seconds, the whole call may take before it
+			raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
+		Returns a list with one Comic object (or exception) per number, in the
+		same order as "numbers"."""
+	with timeouts(deadline=deadline):
+		numbers = [int(number) if type(number) is str and number.isdigit() else number for number in numbers]
+		wanted = [number for number in numbers if number > 0]
+		numComics = 0
+		if len(wanted) > 0:
+			lastChecked = latestComicNum.fetched
+			numComics = getLatestComicNum()
+			# A comic may have been published since the latest number was cached.
+			if max(wanted) > numComics and latestComicNum.fetched == lastChecked:
+				numComics = getLatestComicNum(refresh=True)
+
+		def fetch(number):
+			if number <= 0 or number > numComics:
+				if not silent:
+					print("Error: You have requested an invalid comic.")
+				return Comic(-1)
+			return Comic(number)
+
+		comics = []
+		for number, (comic, error) in zip(numbers, _runConcurrently(fetch, numbers, maxWorkers)):
+			if error is not None:
+				if not silent:
+					print("Error: Unable to fetch comic " + str(number) + ": " + str(error))
+				comic = error
+			comics.append(comic)
+		return comics
+
+def iterComics(start=1, stop=None, prefetch=8, reverse=False):
+	"""	Yields a :class:`Comic` object for every comic from "start" up to, but
+		not including, "stop", in order, while the next "prefetch" comics are
+		fetched in the background. At most that many comics are held ahead of
+		the one being yielded, so memory use does not grow with the range.
+
+		If the loop stops early (by breaking out of it, or by closing or
+		dropping the generator), the background fetches stop as well, after
+		finishing those already under way.
+
+		Arguments:
+			start: the number of the first comic, defaults to 1.
+
+			stop: the number after the last comic, defaults to None, which means
+			every comic up to the latest.
+
+			prefetch: how many comics to fetch ahead, defaults to 8. With 0,
+			every comic is fetched when it is reached.
+
+			reverse: boolean, defaults to False. If set to True, the comics are
+			yielded from the last one down to "start".
+
+		Numbers without a comic (such as 404) are skipped. Any other error is
+		raised by the iteration when that comic's turn comes."""
+	if stop is None:
+		stop = getLatestComicNum() + 1
+	numbers = range(max(1, start), stop)
+	if reverse:
+		numbers = numbers[::-1]
+	if prefetch < 1:
+		for number in numbers:
+			try:
+				comic = Comic(number)
+			except urllib.HTTPError as error:
+				if error.code != 404:
+					raise
+				continue
+			yield comic
+		return
+
+	condition = threading.Condition()
+	# The index of the next comic to fetch and of the first one not yet yielded,
+	# and whether the iteration has stopped.
+	state = {"next": 0, "consumed": 0, "stopped": False}
+	results = {}
+	callerTimeouts = _timeoutOverrides()
+
+	def worker():
+		_local.timeouts = callerTimeouts
+		while True:
+			with condition:
+				while not state["stopped"] and state["next"] < len(numbers) and \
+						state["next"] >= state["consumed"] + prefetch:
+					condition.wait()
+				if state["stopped"] or state["next"] >= len(numbers):
+					return
+				index = state["next"]
+				state["next"] += 1
+			try:
+				result = (Comic(numbers[index]), None)
+			except Exception as error:
+				result = (None, error)
+			with condition:
+				results[index] = result
+				condition.notify_all()
+
+	for i in range(min(prefetch, len(numbers))):
+		thread = threading.Thread(target=worker)
+		thread.daemon = True
+		thread.start()
+
+	try:
+		for index in range(len(numbers)):
+			with condition:
+				while index not in results:
+					condition.wait()
+				comic, error = results.pop(index)
+				state["consumed"] = index + 1
+				condition.notify_all()
+			if error is not None:
+				if isinstance(error, urllib.HTTPError) and error.code == 404:
+					continue
+				raise error
+			yield comic
+	finally:
+		with condition:
+			state["stopped"] = True
+			condition.notify_all()
+
+class Prefetcher:
+
+	"""
+		Warms the caches for the comics a browsing front-end is likely to ask
+		for next. Once installed with :func:`enablePrefetch`, every comic served
+		by :func:`getComic`, :func:`getLatestComic` or :func:`getRandomComic`
+		has its neighbours (the previous and next comics) fetched into the
+		metadata cache in the background, along with a random comic drawn in
+		advance, which the next :func:`getRandomComic` call then returns. With
+		"images" set, their images are fetched into the image cache too.
+
+		Prefetching is best-effort. At most "maxWorkers" comics are fetched at
+		once, and only the "maxQueue" most recent requests wait for a worker;
+		older ones are dropped. The prefetcher downloads at most "maxBytes"
+		bytes a minute, and skips work beyond that. Errors are ignored. The
+		"bytesFetched" and "comicsWarmed" counters record what it has done.
+	"""
+
+	def __init__(self, maxWorkers=2, images=False, x2=False, maxBytes=10 * 1024 * 1024, maxQueue=16):
+		self.maxWorkers = maxWorkers
+		self.images = images
+		self.x2 = x2
+		self.maxBytes = maxBytes
+
+		self.bytesFetched = 0
+		self.comicsWarmed = 0
+
+		self._condition = threading.Condition()
+		self._queue = collections.deque(maxlen=maxQueue)
+		# The numbers queued or being warmed, so none is fetched twice at once.
+		self._pending = set()
+		self._threads = []
+		self._closed = False
+		self._random = None
+		# The start of the current minute of the byte budget, and the bytes spent in it.
+		self._window = (time.time(), 0)
+		addRequestHook(self._countBytes)
+
+	def _countBytes(self, event):
+		# Counts the bytes of the requests made by the prefetcher's own workers.
+		if getattr(_local, "prefetcher", None) is self:
+			with self._condition:
+				self.bytesFetched += event.bytes
+				started, spent = self._window
+				self._window = (started, spent + event.bytes)
+
+	def _hasBudget(self):
+		with self._condition:
+			started, spent = self._window
+			if time.time() - started >= 60:
+				self._window = (time.time(), 0)
+				return True
+			return self.maxBytes is None or spent < self.maxBytes
+
+	def served(self, number):
+		"""	Tells the prefetcher that comic "number" has been served, so that its
+			neighbours, and a random comic if none has been drawn, are warmed."""
+		self.schedule(number - 1)
+		self.schedule(number + 1)
+		with self._condition:
+			needsRandom = self._random is None
+		if needsRandom:
+			self._drawRandom()
+
+	def takeRandom(self, numComics):
+		"""	Returns the random comic number drawn in advance, if there is one
+			between 1 and "numComics", and draws the next; returns None otherwise."""
+		with self._condition:
+			number, self._random = self._random, None
+		self._drawRandom()
+		if number is not None and 1 <= number <= numComics:
+			return number
+		return None
+
+	def _drawRandom(self):
+		number = latestComicNum.number
+		if number is None:
+			return
+		number = _randomComicNumber(number)
+		with self._condition:
+			self._random = number
+		self.schedule(number)
+
+	def schedule(self, number):
+		"""	Queues comic "number" to be warmed, unless it already is or has been."""
+		latest = latestComicNum.number
+		if number <= 0 or (latest is not None and number > latest):
+			return
+		cache = metadataCache
+		if cache is not None and number in cache and not self.images:
+			return
+		with self._condition:
+			if self._closed or number in self._pending:
+				return
+			if len(self._queue) == self._queue.maxlen:
+				self._pending.discard(self._queue.popleft())
+			self._queue.append(number)
+			self._pending.add(number)
+			if len(self._threads) < self.maxWorkers:
+				thread = threading.Thread(target=self._work)
+				thread.daemon = True
+				thread.start()
+				self._threads.append(thread)
+			self._condition.notify()
+
+	def _work(self):
+		_local.prefetcher = self
+		while True:
+			with self._condition:
+				while not self._closed and len(self._queue) == 0:
+					self._condition.wait()
+				if self._closed:
+					return
+				number = self._queue.popleft()
+			try:
+				self._warm(number)
+			except Exception:
+				pass
+			finally:
+				with self._condition:
+					self._pending.discard(number)
+					self._condition.notify_all()
+
+	def _warm(self, number):
+		if metadataCache is None or not self._hasBudget():
+			return
+		comic = Comic(number)
+		if self.images and imageCache is not None and self._hasBudget():
+			comic.getImageBytes(self.x2)
+		with self._condition:
+			self.comicsWarmed += 1
+
+	def wait(self, timeout=None):
+		"""	Waits until nothing is queued or being warmed, or "timeout" seconds
+			have passed. Returns True if the prefetcher is idle."""
+		expires = None if timeout is None else time.time() + timeout
+		with self._condition:
+			while len(self._pending) > 0:
+				remaining = None if expires is None else expires - time.time()
+				if remaining is not None and remaining <= 0:
+					return False
+				self._condition.wait(remaining)
+			return True
+
+	def close(self):
+		"""	Stops the workers once the comics they are warming are done, and
+			drops everything queued."""
+		removeRequestHook(self._countBytes)
+		with self._condition:
+			self._closed = True
+			self._queue.clear()
+			self._pending.clear()
+			self._condition.notify_all()
+
+def enablePrefetch(maxWorkers=2, images=False, x2=False, maxBytes=10 * 1024 * 1024):
+	"""	Installs a :class:`Prefetcher`, so that serving a comic warms the caches
+		for its neighbours and for a random comic. Comics are warmed into the
+		metadata cache; if there is none, an in-memory one is installed until
+		:func:`disablePrefetch` is called. See :func:`setMetadataCache`.
+
+		Arguments:
+			maxWorkers: the maximum number of comics to warm at once, defaults to 2.
+
+			images: boolean, defaults to False. If set to True, the images of the
+			comics are warmed too; this needs an image cache, see :func:`setImageCache`.
+
+			x2: boolean, defaults to False. If set to True, the 2x scaled versions
+			of the images are warmed, where there are any.
+
+			maxBytes: the maximum number of bytes to download a minute, defaults
+			to 10 MiB. None means no limit.
+
+		Returns the new prefetcher."""
+	global prefetcher, _prefetchCache
+	disablePrefetch()
+	if metadataCache is None:
+		_prefetchCache = setMetadataCache()
+	prefetcher = Prefetcher(maxWorkers, images, x2, maxBytes)
+	return prefetcher
+
+def disablePrefetch():
+	"""	Stops and uninstalls the prefetcher installed by :func:`enablePrefetch`,
+		along with the metadata cache it installed, if it did and that cache is
+		still the one in use."""
+	global prefetcher, _prefetchCache
+	if prefetcher is not None:
+		prefetcher.close()
+	prefetcher = None
+	if _prefetchCache is not None and metadataCache is _prefetchCache:
+		disableMetadataCache()
+	_prefetchCache = None
+
+def mirror(directory, x2=False, workers=8, verify=False, silent=True, deadline=None):
+	"""	Maintains a local mirror of every xkcd comic's image and metadata in
+		"directory" (which is created if it does not exist).
+
+		Each comic's info.0.json is saved as (number).json and its image under
+		the same name :func:`Comic.download` would use. A manifest.json file
+		records the number, image name, size and SHA-256 hash of every mirrored
+		image, so later runs only fetch comics published since the last run and
+		any whose image has gone missing or changed size; that makes them almost
+		free. Images already in the mirror are never checked against the server,
+		since published comics do not change; use "verify" to catch local damage.
+		Every file is written to a temporary name and renamed into place, so an
+		interrupted run never leaves a truncated file behind.
+
+		Arguments:
+			directory: the directory holding the mirror.
+
+			x2: boolean, defaults to False. If set to True, the 2x scaled version of
+			each image is mirrored where there is one.
+
+			workers: the maximum number of comics to fetch at once, defaults to 8.
+
+			verify: boolean, defaults to False. If set to True, every mirrored image
+			is hashed again and downloaded again if it no longer matches the manifest.
+
+			silent: boolean, defaults to True. If set to False, an error will be printed
+			to standard output for every comic that could not be mirrored.
+
+			deadline: how long, in seconds, the whole call may take before it
+			raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
+		Returns a dictionary with the latest comic number under "latest", a list of
+		the comics fetched by this run under "downloaded", and a dictionary of
+		numbers that failed (and why) under "failed". Failed comics are retried by
+		the next run."""
+	with timeouts(deadline=deadline):
+		directory = os.path.abspath(os.path.expanduser(directory))
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		manifestPath = os.path.join(directory, "manifest.json")
+		manifest = {"comics": {}}
+		if os.path.exists(manifestPath):
+			with open(manifestPath, "rb") as manifestFile:
+				manifest = json.loads(manifestFile.read().decode("utf-8"))
+		entries = manifest["comics"]
+
+		def isCurrent(number):
+			entry = entries.get(str(number))
+			if entry is None or entry.get("x2", False) != x2:
+				return False
+			# Numbers without a comic (such as 404) are remembered as missing.
+			if entry.get("missing"):
+				return True
+			path = os.path.join(directory, entry["file"])
+			if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+				return False
+			return not verify or _hashFile(path)[0] == entry["sha256"]
+
+		def fetch(number):
+			try:
+				xkcdData = _getComicData(number)
+			except urllib.HTTPError as error:
+				if error.code != 404:
+					raise
+				return {"missing": True, "x2": x2}
+			comic = Comic(number, lazy=True)
+			comic._load(xkcdData)
+			handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+			with os.fdopen(handle, "wb") as metadataFile:
+				metadataFile.write(json.dumps(xkcdData).encode("utf-8"))
+			_replaceFile(temporary, os.path.join(directory, str(number) + ".json"))
+
+			filename = "xkcd-" + str(number) + "-" + comic.imageName
+			path = os.path.join(directory, filename)
+			# Not every comic has a 2x version; fall back to the normal one.
+			headers = _withX2Fallback(comic, x2, lambda link: _downloadImage(link, path))
+			if headers is None:
+				raise IOError("Unable to make file " + path)
+			sha256, size = _hashFile(path)
+			return {"imageName": comic.imageName, "file": filename, "size": size,
+				"sha256": sha256, "x2": x2}
+
+		latest = getLatestComicNum(refresh=True)
+		wanted = [number for number in range(1, latest + 1) if not isCurrent(number)]
+		downloaded = []
+		failed = {}
+		try:
+			for number, (entry, error) in zip(wanted, _runConcurrently(fetch, wanted, workers)):
+				if error is not None:
+					if not silent:
+						print("Error: Unable to mirror comic " + str(number) + ": " + str(error))
+					failed[number] = error
+					continue
+				entries[str(number)] = entry
+				downloaded.append(number)
+		finally:
+			manifest["latest"] = latest
+			handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+			with os.fdopen(handle, "wb") as manifestFile:
+				manifestFile.write(json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+			_replaceFile(temporary, manifestPath)
+		return {"latest": latest, "downloaded": downloaded, "failed": failed}
 
 # Functions that work on What Ifs.
 
-def getWhatIfArchive():
+class WhatIfArchive:
+
+	"""
+		Remembers the parsed What If archive, so that the What If functions do
+		not each download and parse the whole archive page again.
+
+		The archive is refetched once it is older than "ttl" seconds (by default
+		the module-level whatIfArchiveTTL), using a conditional request against
+		the ETag and Last-Modified headers of the previous response; if the
+		archive has not changed, the server replies 304 and the parsed archive
+		is kept. The article numbers are kept sorted, so looking up the latest
+		or a random article does not have to look at the whole archive.
+
+		There is one shared instance, used by :func:`getWhatIfArchive` and the
+		other What If functions. Call its :func:`invalidate` method to force the
+		next lookup to fetch the archive again.
+	"""
+
+	def __init__(self, ttl=None):
+		self.ttl = ttl
+		self.whatifs = {}
+		self.numbers = []
+		self.etag = None
+		self.lastModified = None
+		self.fetched = None
+		self._lock = threading.Lock()
+
+	def isFresh(self):
+		"""	Returns True if the remembered archive can be used without a request."""
+		ttl = self.ttl if self.ttl is not None else whatIfArchiveTTL
+		return self.fetched is not None and time.time() - self.fetched < ttl
+
+	def invalidate(self):
+		"""	Forgets when the archive was fetched, so the next lookup revalidates it."""
+		with self._lock:
+			self.fetched = None
+
+	def _update(self, refresh):
+		if self.isFresh() and not refresh:
+			_emitHit("archive", archiveUrl)
+			return
+		# Concurrent lookups that need the archive fetched share one request.
+		_inFlight.do(self, self._fetch, time.time())
+
+	def _fetch(self, asked):
+		with self._lock:
+			# Another thread may have fetched the archive since it was asked for.
+			if self.fetched is not None and self.fetched >= asked:
+				return
+			if snapshot is not None:
+				self.whatifs = snapshot.getWhatIfs()
+				self.numbers = sorted(self.whatifs)
+				self.fetched = time.time()
+				return
+			headers = {}
+			if len(self.whatifs) > 0:
+				if self.etag:
+					headers["If-None-Match"] = self.etag
+				if self.lastModified:
+					headers["If-Modified-Since"] = self.lastModified
+			response = _request(archiveUrl, headers, category="archive")
+			try:
+				if response.status != 304:
+					parser = WhatIfArchiveParser()
+					for whatif in parser.iterWhatIfs(response):
+						pass
+					self.whatifs = parser.getWhatIfs()
+					self.numbers = sorted(self.whatifs)
+					self.etag = response.getheader("ETag")
+					self.lastModified = response.getheader("Last-Modified")
+				else:
+					response.read()
+			finally:
+				response.close()
+			self.fetched = time.time()
+
+	def get(self, refresh=False):
+		"""	Returns the dictionary mapping article numbers to :class:`WhatIf`
+			objects, fetching or revalidating it first if needed (or if "refresh"
+			is True). The dictionary is shared, so it must not be modified."""
+		self._update(refresh)
+		return self.whatifs
+
+	def latest(self, refresh=False):
+		"""	Returns the :class:`WhatIf` object of the latest article, or None if
+			the archive is empty."""
+		self._update(refresh)
+		whatifs, numbers = self.whatifs, self.numbers
+		if len(numbers) == 0:
+			return None
+		return whatifs[numbers[-1]]
+
+	def random(self):
+		"""	Returns the :class:`WhatIf` object of a randomly chosen article, or
+			None if the archive is empty."""
+		self._update(False)
+		whatifs, numbers = self.whatifs, self.numbers
+		if len(numbers) == 0:
+			return None
+		return whatifs[random.choice(numbers)]
+
+# The shared What If archive, used by getWhatIfArchive() and friends.
+whatIfArchive = WhatIfArchive()
+
+def getWhatIfArchive(refresh=False, deadline=None):
 	"""	Parses the xkcd What If archive. getWhatIfArchive passes the HTML text of
 		the archive page into a :class:`WhatIfArchiveParser` and then calls
 		the parser's :func:`WhatIfArchiveParser.getWhatIfs` method and returns the dictionary produced.
 
+		The parsed archive is remembered for whatIfArchiveTTL seconds (an hour by
+		default) and then revalidated with a conditional request, so calling this
+		repeatedly is cheap; see :class:`WhatIfArchive`.
+
+		Arguments:
+			refresh: boolean, defaults to False. If set to True, the archive is
+			revalidated even if the remembered copy has not expired.
+
+			deadline: how long, in seconds, the whole call may take before it
+			raises :class:`DeadlineExceeded`, defaults to None (no limit).
+
 		This function returns a dictionary mapping article numbers to :class:`WhatIf`
 		objects for every What If article published thus far. If the parsing fails,
 		for whatever reason, the dictionary will be empty."""
-	archive = urllib.urlopen(archiveUrl)
-	text = archive.read()
-	if sys.version_info[0] >= 3:
-		text = text.decode('utf-8')
-	archive.close()
-
-	parser = WhatIfArchiveParser()
-	parser.feed(text)
-	return parser.getWhatIfs()
+	with timeouts(deadline=deadline):
+		return dict(whatIfArchive.get(refresh))
+
+def iterWhatIfArchive():
+	"""	Downloads and parses the xkcd What If archive like :func:`getWhatIfArchive`,
+		but yields each :class:`WhatIf` object as soon as it has been parsed,
+		while the rest of the page is still being downloaded. This always fetches
+		the archive page; it does not use or update the remembered archive."""
+	response = _request(archiveUrl, category="archive")
+	try:
+		parser = WhatIfArchiveParser()
+		for whatif in parser.iterWhatIfs(response):
+			yield whatif
+	finally:
+		response.close()
 
 def getLatestWhatIfNum(archive=None):
 	"""	Returns an integer representing the number of the latest What If article
@@ -431,13 +3203,10 @@ def getLatestWhatIf(archive=None):
 	"""
 
 	if archive is None:
-		archive = getWhatIfArchive()
+		return whatIfArchive.latest()
 
-	# Get the archive keys as a list and sort them by ascending order.
-	# The last entry in keys will be the latest What if.
-	keys = list(archive.keys())
-	keys.sort()
-	return archive[keys[-1]]
+	# The largest key in the archive is the latest What if.
+	return archive[max(archive)]
 
 def getRandomWhatIf():
 	"""	Returns a randomly generated :class:`WhatIf` object, using the Python standard library
@@ -447,10 +3216,7 @@ def getRandomWhatIf():
 		published What Ifs."""
 
 	random.seed()
-	archive = getWhatIfArchive()
-	latest = getLatestWhatIfNum(archive)
-	number = random.randint(1, latest)
-	return archive[number]
+	return whatIfArchive.random()
 
 def getWhatIf(number):
 	"""	Returns a :class:`WhatIf` object corresponding to the What If article of
@@ -467,42 +3233,529 @@ def getWhatIf(number):
 			number: an integer or string that represents a number, this is the index of article to retrieve.
 
 		Returns the resulting :class:`WhatIf` object."""
-	archive = getWhatIfArchive()
-	latest = getLatestWhatIfNum(archive)
-	
 	if type(number) is str and number.isdigit():
 		number = int(number)
-	if number > latest or latest <= 0:
-		return None
-	return archive[number]
+	return whatIfArchive.get().get(number)
+
+# Offline snapshots.
+
+class Snapshot(object):
+
+	"""
+		A read-only, single-file snapshot of comic and What If metadata, as
+		written by :func:`exportSnapshot`. Once installed with :func:`setSnapshot`,
+		:func:`getComic`, :func:`getRandomComic`, :func:`getWhatIf` and the rest
+		are answered entirely from the snapshot, without any network access.
+
+		The file starts with a header and a fixed-width table with the offset and
+		length of every comic and What If, by number, followed by the records
+		themselves as UTF-8 JSON. The file is memory-mapped, so looking up a
+		record only reads its table entry and the record itself; nothing else is
+		loaded or parsed.
+	"""
+
+	magic = b"XKCDSNAP"
+	_header = struct.Struct("<8sIII")
+	_entry = struct.Struct("<II")
+
+	def __init__(self, path):
+		self.path = path
+		self._file = open(path, "rb")
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except Exception:
+			self._file.close()
+			raise
+		magic, version, self.latestComicNum, self.latestWhatIfNum = self._header.unpack_from(self._map, 0)
+		if magic != self.magic or version != 1:
+			self.close()
+			raise ValueError(path + " is not an xkcd snapshot")
+		self._whatIfTable = self._header.size + self.latestComicNum * self._entry.size
+		self._comicNumbers = None
+
+	def close(self):
+		"""	Unmaps and closes the snapshot file."""
+		self._map.close()
+		self._file.close()
+
+	def _record(self, table, count, number):
+		if number < 1 or number > count:
+			return None
+		offset, length = self._entry.unpack_from(self._map, table + (number - 1) * self._entry.size)
+		if length == 0:
+			return None
+		return json.loads(self._map[offset:offset + length].decode("utf-8"))
+
+	def getComicData(self, number):
+		"""	Returns the info.0.json payload of comic "number", or None if the
+			snapshot does not have it."""
+		return self._record(self._header.size, self.latestComicNum, number)
+
+	def getComicNumbers(self):
+		"""	Returns a sorted list of the numbers of every comic in the snapshot.
+			Only the table is read, and only the first time."""
+		if self._comicNumbers is None:
+			numbers = []
+			for number in range(1, self.latestComicNum + 1):
+				offset = self._header.size + (number - 1) * self._entry.size
+				if self._entry.unpack_from(self._map, offset)[1] != 0:
+					numbers.append(number)
+			self._comicNumbers = numbers
+		return self._comicNumbers
+
+	def getWhatIf(self, number):
+		"""	Returns the :class:`WhatIf` object for article "number", or None if
+			the snapshot does not have it."""
+		data = self._record(self._whatIfTable, self.latestWhatIfNum, number)
+		if data is None:
+			return None
+		whatif = WhatIf()
+		whatif.number = number
+		whatif.title = data["title"]
+		return whatif
+
+	def getWhatIfs(self):
+		"""	Returns a dictionary mapping article numbers to :class:`WhatIf`
+			objects for every What If in the snapshot."""
+		whatifs = {}
+		for number in range(1, self.latestWhatIfNum + 1):
+			whatif = self.getWhatIf(number)
+			if whatif is not None:
+				whatifs[number] = whatif
+		return whatifs
+
+def exportSnapshot(path, numbers=None, whatifs=None, maxWorkers=8):
+	"""	Writes a :class:`Snapshot` of comic and What If metadata to the file "path".
+
+		Arguments:
+			path: the file to write.
+
+			numbers: the comic numbers to include. The default of None includes
+			every comic published so far. Comics are looked up like :class:`Comic`
+			does, so a metadata cache or another snapshot is used if installed.
+
+			whatifs: the :class:`WhatIf` objects to include, or None (the default)
+			for every article in the What If archive.
+
+			maxWorkers: the maximum number of comics to fetch at once, defaults to 8.
+
+		Comics that do not exist (such as 404) are left out. Returns the path."""
+	if numbers is None:
+		numbers = range(1, getLatestComicNum() + 1)
+	numbers = sorted(set(int(number) for number in numbers))
+	if whatifs is None:
+		whatifs = whatIfArchive.get().values()
+	whatifs = dict((whatif.number, whatif) for whatif in whatifs if whatif.number > 0)
+
+	comics = {}
+	for number, (data, error) in zip(numbers, _runConcurrently(_getComicData, numbers, maxWorkers)):
+		if error is not None:
+			if isinstance(error, urllib.HTTPError) and error.code == 404:
+				continue
+			raise error
+		comics[number] = data
+
+	latestComic = max(comics) if comics else 0
+	latestWhatIf = max(whatifs) if whatifs else 0
+	records = []
+	for number in range(1, latestComic + 1):
+		records.append(comics.get(number))
+	for number in range(1, latestWhatIf + 1):
+		whatif = whatifs.get(number)
+		records.append({"title": whatif.title} if whatif is not None else None)
+
+	directory = os.path.dirname(os.path.abspath(path))
+	handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+	with os.fdopen(handle, "wb") as snapshotFile:
+		snapshotFile.write(Snapshot._header.pack(Snapshot.magic, 1, latestComic, latestWhatIf))
+		offset = Snapshot._header.size + len(records) * Snapshot._entry.size
+		table = []
+		blobs = []
+		for record in records:
+			if record is None:
+				table.append(Snapshot._entry.pack(0, 0))
+				continue
+			blob = json.dumps(record, separators=(",", ":")).encode("utf-8")
+			table.append(Snapshot._entry.pack(offset, len(blob)))
+			blobs.append(blob)
+			offset += len(blob)
+		snapshotFile.write(b"".join(table))
+		snapshotFile.write(b"".join(blobs))
+	_replaceFile(temporary, path)
+	return path
+
+def setSnapshot(path):
+	"""	Installs the :class:`Snapshot` in the file "path" (or a Snapshot object),
+		so that comics and What Ifs are served from it rather than from the
+		network. The latest comic and What If are the newest ones in the snapshot.
+
+		Returns the installed snapshot. Call :func:`disableSnapshot` to go back to
+		using the network."""
+	global snapshot
+	if not isinstance(path, Snapshot):
+		path = Snapshot(path)
+	snapshot = path
+	whatIfArchive.invalidate()
+	return snapshot
+
+def disableSnapshot():
+	"""	Uninstalls the snapshot set with :func:`setSnapshot`."""
+	global snapshot
+	snapshot = None
+	latestComicNum.invalidate()
+	whatIfArchive.invalidate()
+
+# Searching comics and What Ifs.
+
+class SearchIndex(object):
+
+	"""
+		An inverted index over comic titles and alt-text and What If titles, for
+		answering "which xkcd is about X?" without scanning every comic.
+
+		Text is split into lower-case words, and each word maps to the comics and
+		articles that contain it, weighted so that a word in a title counts for
+		more than one in alt-text. :func:`search` ranks matches by how many of the
+		query's words they contain and how rare those words are.
+
+		An index can be saved to and loaded from a compact gzip-compressed file,
+		and :func:`update` adds only the comics and What Ifs that are not in it
+		yet, including any that could not be fetched last time.
+	"""
+
+	# How much more a word in a title counts than one in alt-text.
+	titleWeight = 3
+
+	def __init__(self):
+		# Word -> {document key: weight}. Keys are "c" or "w" followed by the
+		# number of the comic or What If.
+		self.postings = {}
+		# Document key -> title.
+		self.titles = {}
+		# Comic numbers the site answered 404 for, which update() does not ask for again.
+		self.missing = set()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.titles)
+
+	def __contains__(self, key):
+		return key in self.titles
+
+	@staticmethod
+	def tokenize(text):
+		"""	Returns the list of lower-case words in "text"."""
+		return [word for word in _wordPattern.findall(text.lower()) if len(word) > 1 or word.isdigit()]
+
+	def _add(self, key, title, body):
+		weights = {}
+		for word in self.tokenize(title):
+			weights[word] = weights.get(word, 0) + self.titleWeight
+		for word in self.tokenize(body):
+			weights[word] = weights.get(word, 0) + 1
+		with self._lock:
+			if key in self.titles:
+				return
+			self.titles[key] = title
+			for word, weight in weights.items():
+				self.postings.setdefault(word, {})[key] = weight
+
+	def addComic(self, comic):
+		"""	Indexes the title and alt-text of the :class:`Comic` "comic", unless
+			it is already in the index."""
+		self._add("c" + str(comic.number), comic.title, comic.altText)
+
+	def addWhatIf(self, whatif):
+		"""	Indexes the title of the :class:`WhatIf` "whatif", unless it is
+			already in the index."""
+		self._add("w" + str(whatif.number), whatif.title, "")
+
+	def search(self, query, limit=10, kind=None):
+		"""	Returns the best matches for "query", best first.
+
+			Arguments:
+				query: the words to search for.
+
+				limit: the maximum number of results, defaults to 10.
+
+				kind: "comic" or "whatif" to only return comics or What Ifs,
+				or None (the default) to return both.
+
+			Each result is a tuple of ("comic" or "whatif", number, title)."""
+		prefix = {None: "", "comic": "c", "whatif": "w"}[kind]
+		scores = {}
+		total = float(len(self.titles) + 1)
+		for word in set(self.tokenize(query)):
+			matches = self.postings.get(word)
+			if not matches:
+				continue
+			rarity = math.log(1 + total / len(matches))
+			for key, weight in matches.items():
+				if key.startswith(prefix):
+					scores[key] = scores.get(key, 0) + rarity * weight
+		best = heapq.nlargest(limit, scores.items(), key=lambda pair: (pair[1], pair[0]))
+		kinds = {"c": "comic", "w": "whatif"}
+		return [(kinds[key[0]], int(key[1:]), self.titles[key]) for key, score in best]
+
+	def update(self, maxWorkers=8, whatIfs=True):
+		"""	Adds every comic that is not yet in the index, fetching them with
+			:func:`getComics`, and (if "whatIfs" is True) every What If that is
+			not yet in the index. Comics that failed to fetch are tried again on
+			the next call; numbers without a comic (such as 404) are remembered
+			and skipped.
+
+			Returns the number of comics and What Ifs added."""
+		before = len(self)
+		latest = getLatestComicNum()
+		wanted = [number for number in range(1, latest + 1)
+			if "c" + str(number) not in self.titles and number not in self.missing]
+		for number, comic in zip(wanted, getComics(wanted, maxWorkers)):
+			if isinstance(comic, Comic) and comic.number > 0:
+				self.addComic(comic)
+			elif isinstance(comic, urllib.HTTPError) and comic.code == 404:
+				self.missing.add(number)
+		if whatIfs:
+			for number, whatif in whatIfArchive.get().items():
+				if "w" + str(number) not in self.titles:
+					self.addWhatIf(whatif)
+		return len(self) - before
+
+	def save(self, path):
+		"""	Saves the index to the file "path". Each word is stored once, with its
+			matches packed into a single string, and the file is gzip-compressed."""
+		with self._lock:
+			postings = {}
+			for word, matches in self.postings.items():
+				postings[word] = " ".join(key + ":" + str(weight) for key, weight in matches.items())
+			data = {"version": 1, "titles": self.titles, "postings": postings,
+				"missing": sorted(self.missing)}
+			text = json.dumps(data, separators=(",", ":")).encode("utf-8")
+		directory = os.path.dirname(os.path.abspath(path))
+		handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+		with os.fdopen(handle, "wb") as indexFile:
+			with gzip.GzipFile(fileobj=indexFile, mode="wb") as compressed:
+				compressed.write(text)
+		_replaceFile(temporary, path)
+
+	@classmethod
+	def load(cls, path):
+		"""	Returns the :class:`SearchIndex` saved in the file "path"."""
+		with gzip.open(path, "rb") as indexFile:
+			data = json.loads(indexFile.read().decode("utf-8"))
+		index = cls()
+		index.titles = data["titles"]
+		index.missing = set(data.get("missing", ()))
+		for word, packed in data["postings"].items():
+			matches = {}
+			for match in packed.split(" "):
+				key, weight = match.split(":")
+				matches[key] = int(weight)
+			index.postings[word] = matches
+		return index
 
 # Utility functions
 
-def convertToAscii(string, error="?"):
+def _buildAsciiTransliterations():
+	# Common punctuation, plus every Latin-1 and Latin Extended-A letter whose
+	# decomposition starts with an ASCII letter (so "\u00e9" becomes "e").
+	table = {
+		u"\u00a0": u" ", u"\u00ab": u"<<", u"\u00bb": u">>", u"\u00b7": u".",
+		u"\u00c6": u"AE", u"\u00e6": u"ae", u"\u00d8": u"O", u"\u00f8": u"o", u"\u00df": u"ss",
+		u"\u0152": u"OE", u"\u0153": u"oe", u"\u0141": u"L", u"\u0142": u"l",
+		u"\u2010": u"-", u"\u2011": u"-", u"\u2012": u"-", u"\u2013": u"-", u"\u2014": u"--",
+		u"\u2018": u"'", u"\u2019": u"'", u"\u201a": u",", u"\u201c": u'"', u"\u201d": u'"',
+		u"\u201e": u'"', u"\u2022": u"*", u"\u2026": u"...", u"\u2032": u"'", u"\u2033": u'"',
+		u"\u2212": u"-", u"\u00d7": u"x",
+	}
+	for codepoint in range(0xc0, 0x180):
+		character = _unichr(codepoint)
+		base = unicodedata.normalize("NFKD", character)[:1]
+		if character not in table and base and ord(base) < 128 and base.isalpha():
+			table[character] = base
+	return table
+
+# The transliteration table used by convertToAscii when asked to transliterate.
+asciiTransliterations = _buildAsciiTransliterations()
+
+# Runs of characters that are not ASCII.
+_nonAsciiPattern = re.compile(u"[^\x00-\x7f]+")
+
+def _asciiReplacer(error, table):
+	# Returns a function for re.sub that replaces a run of non-ASCII characters,
+	# transliterating what it can and replacing each remaining run with "error".
+	def replace(match):
+		if table is None:
+			return error
+		pieces = []
+		inError = False
+		for character in match.group(0):
+			replacement = table.get(character)
+			if replacement is not None:
+				pieces.append(replacement)
+				inError = False
+			elif not inError:
+				pieces.append(error)
+				inError = True
+		return u"".join(pieces)
+	return replace
+
+def convertToAscii(string, error="?", table=None):
 	"""	Utility function that converts a unicode string to ASCII. This
 		exists so the :class:`Comic` class can be compatible with Python 2
 		libraries that expect ASCII strings, such as Twisted (as of this writing,
 		anyway). It is unlikely something you will need directly, and its
 		use is discouraged.
 
+		The string is converted in a single pass, so the time taken does not
+		grow with the number of characters that need replacing.
+
 		Arguments:
 
 			string: the string to attempt to convert.
 
 			error: a string that will be substituted into 'string' wherever Python is unable
-			to automatically do the conversion.
+			to automatically do the conversion. A run of several such characters in a
+			row is replaced by a single 'error'.
 
-		convertToAscii returns the converted string."""
+			table: an optional dictionary mapping non-ASCII characters to ASCII
+			replacements, which are used instead of 'error'. Pass
+			xkcd.asciiTransliterations for a table of common punctuation and accented letters.
 
-	running = True
-	asciiString = string
-	while running:
-		try:
-			asciiString = asciiString.encode('ascii')
-		except UnicodeError as unicode:
-			start = unicode.start
-			end = unicode.end
-			asciiString = asciiString[:start] + "?" + asciiString[end:]
-		else:
-			running = False
-	return asciiString
+		convertToAscii returns the converted string as ASCII-encoded bytes (a
+		str on Python 2)."""
+	return _convertToAscii(string, _asciiReplacer(error, table))
+
+def _convertToAscii(string, replace):
+	if isinstance(string, bytes):
+		string = string.decode("utf-8", "replace")
+	return _nonAsciiPattern.sub(replace, string).encode("ascii", "replace")
+
+def convertManyToAscii(strings, error="?", table=None):
+	"""	Converts every string in the iterable "strings" as :func:`convertToAscii`
+		would, and returns a list of the results in the same order."""
+	replace = _asciiReplacer(error, table)
+	return [_convertToAscii(string, replace) for string in strings]
+
+# Asynchronous interface.
+
+class _AsyncCall(object):
+
+	"""	A coroutine that runs a blocking call on an executor. Nothing happens
+		until it is awaited or first sent a value, e.g. by asyncio.create_task,
+		and it then runs on whichever event loop did so."""
+
+	def __init__(self, executor, function):
+		self.executor = executor
+		self.function = function
+		self._waiter = None
+
+	def _wait(self):
+		# Returns the iterator that waits for the call, submitting it first.
+		if self._waiter is None:
+			loop = asyncio.get_event_loop()
+			self._waiter = loop.run_in_executor(self.executor, self.function).__await__()
+		return self._waiter
+
+	def __await__(self):
+		return self._wait()
+
+	def send(self, value):
+		return self._wait().send(value)
+
+	def throw(self, *exception):
+		return self._wait().throw(*exception)
+
+	def close(self):
+		if self._waiter is not None:
+			self._waiter.close()
+
+if asyncio is not None:
+	# Lets asyncio.create_task and asyncio.iscoroutine accept these calls.
+	collections.abc.Coroutine.register(_AsyncCall)
+
+class AsyncClient:
+
+	"""
+		An asyncio interface to xkcd, available as the module-level xkcd.aio
+		object on Python 3.
+
+		Its methods mirror the module functions of the same name, but instead
+		of blocking they return awaitables, so they can be used from an event
+		loop (or passed to asyncio.gather):
+
+			comic = await xkcd.aio.getComic(1691)
+			path = await xkcd.aio.download(comic)
+
+		The calls themselves run on a private pool of at most "maxWorkers"
+		threads, which bounds how many requests are made at once no matter how
+		many tasks are waiting. The results are the same :class:`Comic` and
+		:class:`WhatIf` objects that the synchronous functions return.
+	"""
+
+	def __init__(self, maxWorkers=8):
+		self.maxWorkers = maxWorkers
+		self._executor = None
+		self._lock = threading.Lock()
+
+	def _run(self, function, *args, **kwargs):
+		with self._lock:
+			if self._executor is None:
+				self._executor = concurrent.futures.ThreadPoolExecutor(self.maxWorkers)
+			executor = self._executor
+		return _AsyncCall(executor, functools.partial(function, *args, **kwargs))
+
+	def setMaxWorkers(self, maxWorkers):
+		"""	Changes the number of calls that may run at once. Calls already
+			submitted finish on the old pool."""
+		self.shutdown(wait=False)
+		self.maxWorkers = maxWorkers
+
+	def shutdown(self, wait=True):
+		"""	Stops the worker threads. They are started again by the next call."""
+		with self._lock:
+			executor, self._executor = self._executor, None
+		if executor is not None:
+			executor.shutdown(wait)
+
+	def getLatestComicNum(self, refresh=False, deadline=None):
+		"""	Asynchronous version of :func:`getLatestComicNum`."""
+		return self._run(getLatestComicNum, refresh, deadline)
+
+	def getLatestComic(self):
+		"""	Asynchronous version of :func:`getLatestComic`."""
+		return self._run(getLatestComic)
+
+	def getRandomComic(self):
+		"""	Asynchronous version of :func:`getRandomComic`."""
+		return self._run(getRandomComic)
+
+	def getComic(self, number, silent=True, deadline=None):
+		"""	Asynchronous version of :func:`getComic`."""
+		return self._run(getComic, number, silent, deadline=deadline)
+
+	def getComics(self, numbers, maxWorkers=8, silent=True, deadline=None):
+		"""	Asynchronous version of :func:`getComics`."""
+		return self._run(getComics, list(numbers), maxWorkers, silent, deadline)
+
+	def download(self, comic, output="", outputFile="", silent=True, x2=False, deadline=None):
+		"""	Asynchronous version of :func:`Comic.download` for the comic "comic"."""
+		return self._run(comic.download, output, outputFile, silent, x2, deadline)
+
+	def getWhatIfArchive(self, deadline=None):
+		"""	Asynchronous version of :func:`getWhatIfArchive`."""
+		return self._run(getWhatIfArchive, deadline=deadline)
+
+	def getLatestWhatIf(self, archive=None):
+		"""	Asynchronous version of :func:`getLatestWhatIf`."""
+		return self._run(getLatestWhatIf, archive)
+
+	def getRandomWhatIf(self):
+		"""	Asynchronous version of :func:`getRandomWhatIf`."""
+		return self._run(getRandomWhatIf)
+
+	def getWhatIf(self, number):
+		"""	Asynchronous version of :func:`getWhatIf`."""
+		return self._run(getWhatIf, number)
+
+# The shared asynchronous interface, or None if asyncio is unavailable.
+aio = AsyncClient() if asyncio is not None else None